@@ -1,7 +1,11 @@
 import logging
+import threading
 from abc import ABC, abstractmethod
 import requests
 
+from utils.config import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_POOL_HOST_MAXSIZE
+from utils.session_pool import SessionPool
+
 logger = logging.getLogger(__name__)
 
 
@@ -9,21 +13,45 @@ logger = logging.getLogger(__name__)
 class BaseAPIClient(ABC):
     def __init__(self, base_url):
         self.base_url = base_url
+        self.session_pool = SessionPool(type(self).__name__, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, host_pool_maxsize=HTTP_POOL_HOST_MAXSIZE)
+        self._local = threading.local()
+
+    # Status code of the last response received by the calling thread, None if no response was received
+    @property
+    def last_status_code(self):
+        return getattr(self._local, 'last_status_code', None)
+
+    # Headers of the last response received by the calling thread, e.g. for ETag and Last-Modified
+    @property
+    def last_response_headers(self):
+        return getattr(self._local, 'last_response_headers', None)
+
+    # Thread-local session on the client's shared connection pool
+    @property
+    def session(self):
+        return self.session_pool.session
+
+    def get_pool_stats(self):
+        return self.session_pool.stats()
 
     @abstractmethod
     def get_auth_headers(self):
         pass
 
     def _make_request(self, method, path, **kwargs):
-        headers = self.get_auth_headers()
+        headers = {**self.get_auth_headers(), **(kwargs.pop('headers', None) or {})}
 
         if path.startswith("http://") or path.startswith("https://"):
             url = path
         else:
             url = f"{self.base_url}/{path}"
 
+        self._local.last_status_code = None
+        self._local.last_response_headers = None
         try:
             response = method(url, headers=headers, **kwargs)
+            self._local.last_status_code = response.status_code
+            self._local.last_response_headers = response.headers
             response.raise_for_status()
 
             try:
@@ -41,16 +69,16 @@ class BaseAPIClient(ABC):
             return None
 
     def get(self, path, **kwargs):
-        return self._make_request(requests.get, path, **kwargs)
+        return self._make_request(self.session.get, path, **kwargs)
 
     def post(self, path, data=None, json=None, **kwargs):
-        return self._make_request(requests.post, path, data=data, json=json, **kwargs)
+        return self._make_request(self.session.post, path, data=data, json=json, **kwargs)
 
     def post_upload(self, path, data=None, files=None):
-        return self._make_request(requests.post, path, data=data, files=files)
+        return self._make_request(self.session.post, path, data=data, files=files)
 
     def put(self, path, data=None, json=None, **kwargs):
-        return self._make_request(requests.put, path, data=data, json=json, **kwargs)
+        return self._make_request(self.session.put, path, data=data, json=json, **kwargs)
 
     def delete(self, path, **kwargs):
-        return self._make_request(requests.delete, path, **kwargs)
+        return self._make_request(self.session.delete, path, **kwargs)
@@ -1,16 +1,32 @@
 import os
+import re
+import copy
+import json
 import time
 import base64
 import logging
 import pathlib
 import threading
 import collections
-import requests_pkcs12
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+from requests_pkcs12 import Pkcs12Adapter
+
+from utils.config import DELTA_POOL_MAXSIZE, DELTA_MAX_WORKERS, DELTA_REQUEST_TIMEOUT, DELTA_GRAPH_QUERY_BATCH_SIZE, DELTA_QUERY_BATCH_SIZE, DELTA_STATE_DIR, DELTA_CURSOR_OVERLAP_SECONDS
+from utils.config import DELTA_ADM_ORG_TTL_SECONDS, DELTA_ADM_ORG_MAX_STALE_SECONDS, DELTA_CHANGE_MAX_RETRIES
+from utils.refresh import RefreshCoordinator
+from utils.session_pool import SessionPool
+from utils.state_file import read_state_file, write_state_file
 
 logger = logging.getLogger(__name__)
 
+DELTA_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+CHANGE_CURSOR_VERSION = 1
+ADM_ORG_SNAPSHOT_VERSION = 2
+PLACEHOLDER_PATTERN = re.compile(r'<(\w+)>')
+PAYLOAD_ENDPOINTS = {'queries': '/query', 'graphQueries': '/graph-query', 'queryList': '/history'}
+
 # Harded coded list of employment types to import TODO: FIX THIS!
 employments_to_import = [
     "Assistent HK (RG_3014)",
@@ -46,59 +62,257 @@ employments_to_import = [
 ]
 
 
+# Delta payload loaded once and compiled into a structure with placeholder slots, reloaded when the file changes
+# A slot is a string value with '<name>' placeholders. A value that is only a placeholder is replaced by the param as is (any JSON type),
+# otherwise the params are interpolated into the string
+class PayloadTemplate:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.structure = None
+        self.slots = []
+        self.list_key = None
+        self.endpoint = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        mtime = os.path.getmtime(self.path)
+        with open(self.path, 'r') as file:
+            structure = json.load(file)
+        slots = []
+        stack = [((), structure)]
+        while stack:
+            path, node = stack.pop()
+            items = node.items() if isinstance(node, dict) else enumerate(node) if isinstance(node, list) else ()
+            for key, value in items:
+                if isinstance(value, str):
+                    names = PLACEHOLDER_PATTERN.findall(value)
+                    if names:
+                        whole = PLACEHOLDER_PATTERN.fullmatch(value) is not None
+                        slots.append((path + (key,), value, names[0] if whole else None, tuple(names)))
+                else:
+                    stack.append((path + (key,), value))
+        self.list_key = next((key for key in PAYLOAD_ENDPOINTS if key in structure), None)
+        self.endpoint = PAYLOAD_ENDPOINTS.get(self.list_key)
+        self.structure, self.slots, self.mtime = structure, slots, mtime
+
+    def reload_if_changed(self):
+        with self._lock:
+            if os.path.getmtime(self.path) != self.mtime:
+                logger.info(f'Reloading payload {self.path}')
+                self._load()
+        return self
+
+    # Returns the payload structure with params, only containers on the path to a slot are copied
+    def render(self, params):
+        result = copy.copy(self.structure)
+        copied = {(): result}
+        for path, value, whole_name, names in self.slots:
+            missing = [name for name in names if name not in params]
+            if missing:
+                raise KeyError(f'Missing params {missing} for payload {self.path}')
+            container = result
+            for i, key in enumerate(path[:-1]):
+                if path[:i + 1] not in copied:
+                    container[key] = copy.copy(container[key])
+                    copied[path[:i + 1]] = container[key]
+                container = container[key]
+            if whole_name:
+                container[path[-1]] = params[whole_name]
+            else:
+                container[path[-1]] = PLACEHOLDER_PATTERN.sub(lambda match: str(params[match.group(1)]), value)
+        return result
+
+    def render_bytes(self, params):
+        return json.dumps(self.render(params)).encode('utf-8')
+
+    # Returns one payload with the query list (e.g. 'graphQueries' or 'queries') rendered with each set of params
+    def render_batch_bytes(self, params_list):
+        body = None
+        queries = []
+        for params in params_list:
+            rendered = self.render(params)
+            body = body or rendered
+            queries.extend(rendered[self.list_key])
+        body = dict(body)
+        body[self.list_key] = queries
+        return json.dumps(body).encode('utf-8')
+
+
+# Iterative pre-order walk of adm. org. units in a graph query result, yields (uuid, parent uuid) tuples
+def _walk_adm_org_units(instances):
+    stack = [(adm, None) for adm in reversed(instances)]
+    while stack:
+        adm, parent = stack.pop()
+        uuid = adm.get('identity', {}).get('uuid')
+        if uuid:
+            yield uuid, parent
+        for child in reversed(adm.get('childrenObjects', [])):
+            stack.append((child, uuid or parent))
+
+
+# Index of the adm. org. tree (parents in tree order) and the adm. org. units with employees
+# grants has the adm. org. units with employees as keys and the sub adm. org. units they grant as values
+class AdmOrgIndex:
+    def __init__(self, grants=None, parents=None):
+        self.grants = grants or {}
+        self.parents = parents or {}
+        self.children = collections.defaultdict(list)
+        for uuid, parent in self.parents.items():
+            if parent is not None:
+                self.children[parent].append(uuid)
+        self.all_organizations = list(dict.fromkeys(uuid for key, values in self.grants.items() for uuid in [key] + values))
+        self.all_organizations_set = set(self.all_organizations)
+        self._ancestors = {}
+        self._descendants = {}
+
+    @classmethod
+    def from_graph_instances(cls, instances):
+        parents = {}
+        for uuid, parent in _walk_adm_org_units(instances):
+            parents.setdefault(uuid, parent)
+        return cls(parents=parents)
+
+    def with_grants(self, grants):
+        return AdmOrgIndex(grants, self.parents)
+
+    # Adm. org. units in tree order
+    @property
+    def tree_order(self):
+        return list(self.parents)
+
+    # Returns the adm. org. unit itself and the sub adm. org. units it grants, or None if it has no employees
+    def granted_units(self, uuid):
+        if uuid not in self.grants:
+            return None
+        return [uuid] + self.grants[uuid]
+
+    def ancestors(self, uuid):
+        if uuid not in self._ancestors:
+            ancestors = set()
+            parent = self.parents.get(uuid)
+            while parent is not None and parent not in ancestors:
+                ancestors.add(parent)
+                parent = self.parents.get(parent)
+            self._ancestors[uuid] = ancestors
+        return self._ancestors[uuid]
+
+    def descendants(self, uuid):
+        if uuid not in self._descendants:
+            descendants = set()
+            stack = list(self.children.get(uuid, []))
+            while stack:
+                child = stack.pop()
+                if child not in descendants:
+                    descendants.add(child)
+                    stack.extend(self.children.get(child, []))
+            self._descendants[uuid] = descendants
+        return self._descendants[uuid]
+
+    # Removes adm. org. units with sub adm. org. units that have employees themselves, keeps the order of units_with_employees
+    @staticmethod
+    def prune_units_with_employees(units_with_employees):
+        keys = set(units_with_employees)
+        return {key: value for key, value in units_with_employees.items() if keys.isdisjoint(value)}
+
+
 class DeltaClient:
-    def __init__(self, cert_base64, cert_pass, base_url, top_adm_org_uuid, relative_assets_path='assets/delta/'):
+    def __init__(self, cert_base64, cert_pass, base_url, top_adm_org_uuid, relative_assets_path='assets/delta/', pool_maxsize=DELTA_POOL_MAXSIZE,
+                 max_workers=DELTA_MAX_WORKERS, request_timeout=DELTA_REQUEST_TIMEOUT, graph_query_batch_size=DELTA_GRAPH_QUERY_BATCH_SIZE,
+                 query_batch_size=DELTA_QUERY_BATCH_SIZE, state_dir=DELTA_STATE_DIR, cursor_overlap_seconds=DELTA_CURSOR_OVERLAP_SECONDS,
+                 adm_org_ttl_seconds=DELTA_ADM_ORG_TTL_SECONDS, adm_org_max_stale_seconds=DELTA_ADM_ORG_MAX_STALE_SECONDS,
+                 change_max_retries=DELTA_CHANGE_MAX_RETRIES):
         self.cert_base64 = cert_base64
         self.cert_pass = cert_pass
         self.base_url = base_url
         self.top_adm_org_uuid = top_adm_org_uuid
         self.assets_path = os.path.join(pathlib.Path(__file__).parent.resolve(), relative_assets_path)
         self.last_adm_org_list_updated = None
-        self.adm_org_list = None
+        self.adm_org_index = None
         self.cert_data = base64.b64decode(cert_base64)
-        self.payloads = {os.path.splitext(file)[0]: os.path.join(os.path.join(self.assets_path, 'payloads/'), file) for file in os.listdir(os.path.join(self.assets_path, 'payloads/')) if file.endswith('.json')}
+        self.payloads = {os.path.splitext(file)[0]: PayloadTemplate(os.path.join(os.path.join(self.assets_path, 'payloads/'), file)) for file in os.listdir(os.path.join(self.assets_path, 'payloads/')) if file.endswith('.json')}
         self.headers = {'Content-Type': 'application/json'}
+        self.pool_maxsize = pool_maxsize
+        self.session_pool = None
+        self._session_pool_lock = threading.Lock()
+        self.max_workers = max_workers
+        self.request_timeout = request_timeout
+        self.graph_query_batch_size = max(graph_query_batch_size, 1)
+        self.query_batch_size = max(query_batch_size, 1)
+        self.change_cursor_path = os.path.join(state_dir, 'delta_change_cursor.json') if state_dir else None
+        self.cursor_overlap = timedelta(seconds=cursor_overlap_seconds)
+        self.pending_change_cursor = None
+        self.change_max_retries = change_max_retries
+        self.adm_org_snapshot_path = os.path.join(state_dir, 'delta_adm_org_snapshot.json') if state_dir else None
+        self.adm_org_list_from_snapshot = False
+        self.adm_org_refresh = RefreshCoordinator('delta_adm_org_list', self._update_job, lambda: self.last_adm_org_list_updated,
+                                                  ttl_seconds=adm_org_ttl_seconds, max_stale_seconds=adm_org_max_stale_seconds)
+        self._load_adm_org_snapshot()
+        self.adm_org_probe_failures = {}
 
     def _get_cert_data_and_pass(self):
         if self.cert_data is not None and self.cert_pass is not None:
             return self.cert_data, self.cert_pass
         return False, False
 
+    # The certificate is parsed into an SSL context once and mounted on a pooled keep-alive session shared by all queries
+    def _get_session(self):
+        if self.session_pool is None:
+            with self._session_pool_lock:
+                if self.session_pool is None:
+                    cert_data, cert_pass = self._get_cert_data_and_pass()
+                    self.session_pool = SessionPool(type(self).__name__, pool_connections=1, pool_maxsize=self.pool_maxsize, adapter_factory=Pkcs12Adapter, pkcs12_data=cert_data, pkcs12_password=cert_pass)
+        return self.session_pool.session
+
     def _get_payload(self, payload_name):
         if payload_name.endswith('.json'):
             payload_name = os.path.splitext(payload_name)[0]
-        payload_path = self.payloads.get(payload_name)
-        if payload_path:
-            with open(payload_path, 'r') as file:
-                return file.read()
+        payload_template = self.payloads.get(payload_name)
+        if payload_template:
+            return payload_template.reload_if_changed()
         else:
             logger.error(f'Payload "{payload_name}" not found.')
             return
 
+    # Returns the payload template rendered with params as request body bytes
     def _set_params(self, payload, params):
-        if isinstance(payload, str):
+        if isinstance(payload, PayloadTemplate):
             if isinstance(params, dict):
-                for key, value in params.items():
-                    key = key.replace('<', '').replace('>', '') if key and '<' in key and '>' in key else key
-                    payload = payload.replace(f'<{key}>', value)
+                try:
+                    return payload.render_bytes({key.strip('<>'): value for key, value in params.items()})
+                except KeyError as e:
+                    logger.error(e)
+                    return
             else:
                 logger.error('Params must be a dictionary.')
                 return
         else:
-            logger.error('Payload must be a string.')
+            logger.error('Payload must be a payload template.')
+            return
+
+    # Packs the query list (e.g. 'graphQueries' or 'queries') of the payload with each set of params into one request body
+    def _set_params_batch(self, payload, params_list):
+        if not isinstance(payload, PayloadTemplate):
+            logger.error('Payload must be a payload template.')
+            return
+        try:
+            return payload.render_batch_bytes(params_list)
+        except KeyError as e:
+            logger.error(e)
             return
-        return payload
 
-    def _make_post_request(self, payload):
+    # endpoint is the endpoint of the payload's template, e.g. /query
+    def _make_post_request(self, payload, endpoint):
         cert_data, cert_pass = self._get_cert_data_and_pass()
         if cert_data and cert_pass:
             try:
-                path = '/query' if 'queries' in payload else '/graph-query' if 'graphQueries' in payload else '/history' if 'queryList' in payload else None
-                if not path:
+                if not endpoint:
                     logger.error('Payload is invalid.')
                     return
-                url = self.base_url.rstrip('/') + path
-                response = requests_pkcs12.post(url, data=payload, headers=self.headers, pkcs12_data=cert_data, pkcs12_password=cert_pass)
+                payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+                url = self.base_url.rstrip('/') + endpoint
+                response = self._get_session().post(url, data=payload, headers=self.headers, timeout=self.request_timeout)
                 return response
             except Exception as e:
                 logger.error(f'Error making POST request: {e}')
@@ -106,63 +320,84 @@ class DeltaClient:
             logger.error('Certificate path or password is invalid.')
         return
 
-    def _recursive_get_adm_org_units(self, adm_unit_tree_json, list_of_adm_units):
-        for adm in adm_unit_tree_json:
-            if 'identity' in adm:
-                if 'uuid' in adm['identity']:
-                    list_of_adm_units.append(adm['identity']['uuid'])
-            if 'childrenObjects' in adm:
-                for child in adm['childrenObjects']:
-                    self._recursive_get_adm_org_units([child], list_of_adm_units)
+    # The adm. org. list is served from the index, setting it builds an index without the org. tree
+    @property
+    def adm_org_list(self):
+        return self.adm_org_index.grants if self.adm_org_index else None
+
+    @adm_org_list.setter
+    def adm_org_list(self, adm_org_list):
+        self.adm_org_index = AdmOrgIndex(adm_org_list) if adm_org_list is not None else None
+
+    # Probes a batch of adm. org. units in one graph query request
+    # Returns a dict with a list of sub adm. org. units for each adm. org. unit with employees, otherwise None
+    def _probe_adm_org_batch(self, adm_org_batch, payload):
+        payload_with_params = self._set_params_batch(payload, [{'uuid': adm_org} for adm_org in adm_org_batch])
+        if not payload_with_params:
+            raise Exception('Error setting payload params.')
+        r = self._make_post_request(payload_with_params, payload.endpoint)
+        if r is None:
+            raise Exception('No response from Delta.')
+        r.raise_for_status()
+        graph_query_results = r.json()['graphQueryResult']
+        if len(graph_query_results) != len(adm_org_batch):
+            raise Exception(f'Expected {len(adm_org_batch)} graph query results, got {len(graph_query_results)}.')
+
+        results = {}
+        for adm_org, graph_query_result in zip(adm_org_batch, graph_query_results):
+            results[adm_org] = None
+            if len(graph_query_result['instances']) > 0:
+                results[adm_org] = [uuid for uuid, _ in _walk_adm_org_units(graph_query_result['instances']) if uuid != adm_org]
+        return results
+
+    # Probes all adm. org. units in concurrent batches, failures are collected in self.adm_org_probe_failures
+    def _probe_adm_org_units(self, adm_org_list, payload):
+        results = {}
+        failures = {}
+        batches = [adm_org_list[i:i + self.graph_query_batch_size] for i in range(0, len(adm_org_list), self.graph_query_batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._probe_adm_org_batch, batch, payload): batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    results.update(future.result())
+                except Exception as e:
+                    failures.update({adm_org: str(e) for adm_org in futures[future]})
+        self.adm_org_probe_failures = failures
+        return results, failures
 
     def _check_has_employees_and_add_sub_adm_org_units(self, adm_org_list, payload):
         try:
-            adm_org_dict = {}
-            for adm_org in adm_org_list:
-                payload_with_params = self._set_params(payload, {'uuid': adm_org})
-                if not payload_with_params:
-                    logger.error('Error setting payload params.')
-                    return
-                r = self._make_post_request(payload_with_params)
-                r.raise_for_status()
-                json_res = r.json()
-                if len(json_res['graphQueryResult'][0]['instances']) > 0:
-                    sub_adm_orgs = []
-                    self._recursive_get_adm_org_units(json_res['graphQueryResult'][0]['instances'], sub_adm_orgs)
-                    sub_adm_orgs = [e for e in sub_adm_orgs if e != adm_org]
-                    adm_org_dict[adm_org] = sub_adm_orgs
-
-            # Deletes adm. org. units with sub adm. org. units with employees
-            keys_to_remove = []
-            for key, value in adm_org_dict.items():
-                for sub_adm_org in value:
-                    if sub_adm_org in adm_org_dict.keys() and key not in keys_to_remove:
-                        keys_to_remove.append(key)
-                        break
+            results, failures = self._probe_adm_org_units(adm_org_list, payload)
+            if failures:
+                logger.error(f'{len(failures)} of {len(adm_org_list)} adm. org. unit probes failed, e.g. {next(iter(failures.items()))}')
+                return
 
-            for key in keys_to_remove:
-                adm_org_dict.pop(key)
+            # Built in org. tree order so the result is deterministic
+            adm_org_dict = {adm_org: results[adm_org] for adm_org in adm_org_list if results[adm_org] is not None}
 
-            return adm_org_dict
+            # Deletes adm. org. units with sub adm. org. units with employees
+            return AdmOrgIndex.prune_units_with_employees(adm_org_dict)
         except Exception as e:
             logger.error(f'Error checking sub adm. org. and employees: {e}')
             return
 
-    def _get_adm_org_list(self):
+    # Returns an AdmOrgIndex of the org. tree below the top adm. org. unit with the units that have employees
+    def _get_adm_org_index(self):
         try:
             payload = self._get_payload('adm_org_tree')
             payload_with_params = self._set_params(payload, {'uuid': self.top_adm_org_uuid})
             if not payload_with_params:
                 logger.error('Error setting payload params.')
                 return
-            r = self._make_post_request(payload_with_params)
+            r = self._make_post_request(payload_with_params, payload.endpoint)
             r.raise_for_status()
             json_res = r.json()
             if len(json_res['graphQueryResult'][0]['instances']) > 0:
-                adm_org_list = []
-                self._recursive_get_adm_org_units(json_res['graphQueryResult'][0]['instances'], adm_org_list)
+                adm_org_index = AdmOrgIndex.from_graph_instances(json_res['graphQueryResult'][0]['instances'])
                 payload = self._get_payload('adm_ord_with_employees_two_layers_down')
-                return self._check_has_employees_and_add_sub_adm_org_units(adm_org_list, payload)
+                adm_org_list = self._check_has_employees_and_add_sub_adm_org_units(adm_org_index.tree_order, payload)
+                if adm_org_list is not None:
+                    return adm_org_index.with_grants(adm_org_list)
         except Exception as e:
             logger.error(f'Error getting adm. org. list: {e}')
             return
@@ -170,72 +405,211 @@ class DeltaClient:
     def _update_job(self):
         logger.info('Updating adm. org. list')
         start = time.time()
-        adm_org_list = self._get_adm_org_list()
-        if adm_org_list:
-            self.adm_org_list = adm_org_list
+        adm_org_index = self._get_adm_org_index()
+        if adm_org_index and adm_org_index.grants:
+            self.adm_org_index = adm_org_index
             self.last_adm_org_list_updated = datetime.now()
+            self.adm_org_list_from_snapshot = False
+            self._save_adm_org_snapshot()
             logger.info(f'Administrative organizations {len(self.adm_org_list)}')
             logger.info(f'Adm. org. list updated in {str(timedelta(seconds=(time.time() - start)))}')
+            return True
         else:
             logger.error('Error adm. org. list not updated.')
+            return False
+
+    # Loads the adm. org. list saved by a previous process, so it can be served while it is refreshed in the background
+    def _load_adm_org_snapshot(self):
+        snapshot = read_state_file(self.adm_org_snapshot_path)
+        if not snapshot:
+            return
+        if snapshot.get('version') != ADM_ORG_SNAPSHOT_VERSION or snapshot.get('top_adm_org_uuid') != self.top_adm_org_uuid:
+            logger.info('Adm. org. snapshot is outdated - ignoring')
+            return
+        self.adm_org_index = AdmOrgIndex(snapshot['adm_org_list'], snapshot['parents'])
+        self.last_adm_org_list_updated = datetime.fromisoformat(snapshot['updated'])
+        self.adm_org_list_from_snapshot = True
+        logger.info(f'Loaded adm. org. snapshot from {snapshot["updated"]} with {len(self.adm_org_list)} administrative organizations')
+
+    def _save_adm_org_snapshot(self):
+        write_state_file(self.adm_org_snapshot_path, {
+            'version': ADM_ORG_SNAPSHOT_VERSION,
+            'top_adm_org_uuid': self.top_adm_org_uuid,
+            'updated': self.last_adm_org_list_updated.isoformat(),
+            'adm_org_list': self.adm_org_index.grants,
+            'parents': self.adm_org_index.parents
+        })
 
     def _update_adm_org_list_background(self):
-        logger.info('Background update')
-        thread = threading.Thread(target=self._update_job)
-        thread.start()
+        if self.adm_org_refresh.refresh_in_background():
+            logger.info('Background update')
 
     # returns a dictionaries with the admin organization unit UUID as the key and a list of sub admin organization unit UUIDs as the value
+    # Only one update runs at a time, concurrent callers are served the current list or wait for the running update
     def get_adm_org_list(self):
-        if not self.adm_org_list:
+        if not self.adm_org_list or self.adm_org_refresh.is_too_stale():
             logger.info('Foreground update')
-            self._update_job()
-        else:
-            if self.last_adm_org_list_updated:
-                # Update every hour
-                if (datetime.now() - self.last_adm_org_list_updated).total_seconds() > 60 * 60:
-                    self._update_adm_org_list_background()
-            else:
-                self._update_adm_org_list_background()
+            self.adm_org_refresh.refresh()
+        elif self.adm_org_list_from_snapshot:
+            # Serve the snapshot and refresh it once after startup
+            self.adm_org_list_from_snapshot = False
+            self._update_adm_org_list_background()
+        elif self.adm_org_refresh.is_expired():
+            self._update_adm_org_list_background()
         return self.adm_org_list
 
     # Returns all ids in the adm org list dict as a list
     def get_all_organizations(self):
-        return [item for key, values in self.get_adm_org_list().items() for item in [key] + values]
+        self.get_adm_org_list()
+        return self.adm_org_index.all_organizations
+
+    # Looks up a batch of employees (engagements) in one query request
+    # Returns a dict with the employee UUID as key and the query result as value
+    def _query_employee_batch(self, employee_batch, payload):
+        payload_with_params = self._set_params_batch(payload, [{'uuid': employee} for employee in employee_batch])
+        if not payload_with_params:
+            raise Exception('Error setting payload params.')
+        r = self._make_post_request(payload_with_params, payload.endpoint)
+        if r is None:
+            raise Exception('No response from Delta.')
+        r.raise_for_status()
+        query_results = r.json()['queryResults']
+        if len(query_results) != len(employee_batch):
+            raise Exception(f'Expected {len(employee_batch)} query results, got {len(query_results)}.')
+        return dict(zip(employee_batch, query_results))
+
+    # Looks up employees in concurrent batches, employees in a failed batch are looked up one by one if fallback is set
+    def _get_employee_query_results(self, employee_uuids, payload, fallback=True):
+        results = {}
+        retry = []
+        batches = [employee_uuids[i:i + self.query_batch_size] for i in range(0, len(employee_uuids), self.query_batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._query_employee_batch, batch, payload): batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    results.update(future.result())
+                except Exception as e:
+                    if not fallback or len(futures[future]) == 1:
+                        raise
+                    logger.warning(f'Batched employee lookup failed, looking up {len(futures[future])} employees one by one: {e}')
+                    retry.extend(futures[future])
+            for result in executor.map(lambda employee: self._query_employee_batch([employee], payload), retry):
+                results.update(result)
+        return results
+
+    # Returns the DQ number and employment type of an active employee with a relation to the admin unit
+    def _get_dq_number_and_employment_type(self, query_result, adm_unit):
+        dq_number = None
+        employment_type = None
+        if len(query_result['instances']) > 0:
+            first_res = query_result['instances'][0]
+            # Check employee is active
+            if first_res['state'] == 'STATE_ACTIVE' and len(first_res['typeRefs']) > 0:
+                for relation in first_res['typeRefs']:
+                    if relation['userKey'] == 'APOS-Types-Engagement-TypeRelation-AdmUnit':
+                        # Check if relation to admin unit is correct
+                        if relation['refObjIdentity']['uuid'] == adm_unit:
+                            if len(first_res["inTypeRefs"]) > 0:
+                                for ref in first_res["inTypeRefs"]:
+                                    if ref['refObjTypeUserKey'] == 'APOS-Types-User':
+                                        dq_number = ref['refObjIdentity']['userKey']
+                    elif relation['userKey'] == 'APOS-Types-Engagement-TypeRelation-Position':
+                        employment_type = relation['refObjIdentity']['userKey']
+        return dq_number, employment_type
+
+    # Returns the persisted high-water mark of handled changes as a dict with 'to_time', 'seen' registrations and the 'retry' changes
+    # of failed employees, or None
+    def _load_change_cursor(self):
+        cursor = read_state_file(self.change_cursor_path)
+        if not cursor or cursor.get('version') != CHANGE_CURSOR_VERSION:
+            return None
+        return cursor
+
+    # Persists the cursor of the last get_employees_changed call, call when the changes have been handled.
+    # The changes of failed_employees (items returned by get_employees_changed) are returned again by the next calls,
+    # at most change_max_retries times, so a failing employee never holds the cursor back
+    def commit_change_cursor(self, failed_employees=None):
+        if self.pending_change_cursor and self.change_cursor_path:
+            cursor = {**self.pending_change_cursor, 'retry': self._retry_changes(failed_employees or [])}
+            if write_state_file(self.change_cursor_path, cursor):
+                logger.info(f'Delta change cursor committed at {cursor["to_time"]} with {len(cursor["retry"])} changes to retry')
+                self.pending_change_cursor = None
+                return True
+        return False
+
+    def _retry_changes(self, failed_employees):
+        retry = []
+        for employee in failed_employees:
+            change = employee.get('change')
+            if not change:
+                continue
+            if change['attempts'] >= self.change_max_retries:
+                logger.warning(f"Giving up on the change of {employee['user']} from {change['time']} after {change['attempts']} retries")
+                continue
+            retry.append({**change, 'attempts': change['attempts'] + 1})
+        return retry
 
     # Returns a list of dictionaries with key 'user' containing DQ-numberand key 'organizations' containing a list of UUIDs for organizations they need access to
+    # and key 'change' with the registration it was found from, to pass to commit_change_cursor if it fails.
+    # With a state dir the query resumes from the committed change cursor instead of time_back_minutes, and the changes to retry are included
     def get_employees_changed(self, time_back_minutes=30):
         try:
-            adm_org_units_with_employees = self.get_adm_org_list()
-            if not adm_org_units_with_employees:
+            self.get_adm_org_list()
+            adm_org_index = self.adm_org_index
+            if not adm_org_index or not adm_org_index.grants:
                 raise Exception('Error getting adm. org. units with employees.')
 
             start = time.time()
             payload_changes = self._get_payload('employee_changes')
 
             # Delta uses UTC time
-            time_back_minutes = timedelta(minutes=time_back_minutes)
-            from_time = (datetime.now(tz=timezone.utc) - time_back_minutes).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
-            to_time = datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+            now = datetime.now(tz=timezone.utc).replace(tzinfo=None)
+            cursor = self._load_change_cursor() if self.change_cursor_path else None
+            if cursor:
+                # Overlap with the previous window to catch late registrations, already handled ones are skipped by 'seen'
+                from_datetime = datetime.strptime(cursor['to_time'], DELTA_TIME_FORMAT) - self.cursor_overlap
+                seen_registrations = set(cursor['seen'])
+                retry_changes = cursor.get('retry', [])
+            else:
+                from_datetime = now - timedelta(minutes=time_back_minutes)
+                seen_registrations = set()
+                retry_changes = []
+            from_time = from_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+            to_time = now.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
 
             payload_changes_with_params = self._set_params(payload_changes, {'fromTime': from_time, "toTime": to_time})
 
-            r = self._make_post_request(payload_changes_with_params)
+            r = self._make_post_request(payload_changes_with_params, payload_changes.endpoint)
             r.raise_for_status()
 
-            changes_list = []
+            # Changes of failed employees first, so they keep their attempts if the same registration is also returned
+            changes_list = [{'employee': change['employee'], 'admunit': change['admunit'], 'time': datetime.strptime(change['time'], DELTA_TIME_FORMAT),
+                             'attempts': change['attempts']} for change in retry_changes if change['admunit'] in adm_org_index.grants]
             json_res = r.json()
             employee_changed_list = []
 
+            registration_list = json_res['queryResultList'][0]['registrationList']
+            overlap_start = now - self.cursor_overlap
+            self.pending_change_cursor = {
+                'version': CHANGE_CURSOR_VERSION,
+                'to_time': to_time,
+                'seen': sorted(f"{change['objectUuid']}|{change['regDateTime']}" for change in registration_list
+                               if datetime.strptime(change['regDateTime'], DELTA_TIME_FORMAT) >= overlap_start)
+            }
+
             # If any changes
-            if len(json_res['queryResultList'][0]['registrationList']) > 0:
+            if len(registration_list) > 0:
                 # Iterate over changes
-                for change in json_res['queryResultList'][0]['registrationList']:
+                for change in registration_list:
+                    # Skip registrations handled by a previous run
+                    if f"{change['objectUuid']}|{change['regDateTime']}" in seen_registrations:
+                        continue
                     if len(change['typeRefBiList']) > 0:
                         # If change to admin unit
                         if change['typeRefBiList'][0]['value']['userKey'] == 'APOS-Types-Engagement-TypeRelation-AdmUnit':
                             # if admin unit is relevant (on the list)
-                            if change['typeRefBiList'][0]["value"]["refObjIdentity"]['uuid'] in adm_org_units_with_employees.keys():
-                                changes_list.append({'employee': change['objectUuid'], 'admunit': change['typeRefBiList'][0]["value"]["refObjIdentity"]['uuid'], 'time': datetime.strptime(change['regDateTime'], '%Y-%m-%dT%H:%M:%S.%fZ')})
+                            if change['typeRefBiList'][0]["value"]["refObjIdentity"]['uuid'] in adm_org_index.grants:
+                                changes_list.append({'employee': change['objectUuid'], 'admunit': change['typeRefBiList'][0]["value"]["refObjIdentity"]['uuid'], 'time': datetime.strptime(change['regDateTime'], DELTA_TIME_FORMAT), 'attempts': 0})
 
             # Split _list into a list of lists (for each employee)
             by_employee = collections.defaultdict(list)
@@ -251,31 +625,14 @@ class DeltaClient:
 
             if len(employee_list) > 0:
                 payload_employee = self._get_payload('employee_dq_number')
+                query_results = self._get_employee_query_results([employee['employee'] for employee in employee_list], payload_employee)
                 for employee in employee_list:
-                    dq_number = None
-                    employment_type = None
-                    payload_employee_with_params = self._set_params(payload_employee, {'uuid': employee['employee']})
-                    r = self._make_post_request(payload_employee_with_params)
-                    r.raise_for_status()
-                    json_res = r.json()
-                    if len(json_res['queryResults'][0]['instances']) > 0:
-                        first_res = json_res['queryResults'][0]['instances'][0]
-                        # Check employee is active
-                        if first_res['state'] == 'STATE_ACTIVE' and len(first_res['typeRefs']) > 0:
-                            for relation in first_res['typeRefs']:
-                                if relation['userKey'] == 'APOS-Types-Engagement-TypeRelation-AdmUnit':
-                                    # Check if relation to admin unit is correct
-                                    if relation['refObjIdentity']['uuid'] == employee['admunit']:
-                                        if len(first_res["inTypeRefs"]) > 0:
-                                            for ref in first_res["inTypeRefs"]:
-                                                if ref['refObjTypeUserKey'] == 'APOS-Types-User':
-                                                    dq_number = ref['refObjIdentity']['userKey']
-                                elif relation['userKey'] == 'APOS-Types-Engagement-TypeRelation-Position':
-                                    employment_type = relation['refObjIdentity']['userKey']
-
+                    dq_number, employment_type = self._get_dq_number_and_employment_type(query_results[employee['employee']], employee['admunit'])
                     if dq_number and employment_type in employments_to_import:
                         # Add employee to dictionary with key DQ number and value admin unit UUID
-                        employee_changed_list.append({'user': dq_number, 'organizations': [employee['admunit']] + adm_org_units_with_employees[employee['admunit']]})
+                        change = {'employee': employee['employee'], 'admunit': employee['admunit'], 'attempts': employee['attempts'],
+                                  'time': employee['time'].strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'}
+                        employee_changed_list.append({'user': dq_number, 'organizations': adm_org_index.granted_units(employee['admunit']), 'change': change})
 
             logger.info(f'Employees with changes {len(employee_changed_list)}')
             logger.info(f'Got employee changes in {str(timedelta(seconds=(time.time() - start)))}')
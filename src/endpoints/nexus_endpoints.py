@@ -4,7 +4,8 @@ import logging
 from nexus.nexus_client import NexusClient
 from flask import Blueprint, request, jsonify
 from utils.config import NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL
-from jobs.nexus_flow_lukning import execute_lukning
+from utils.streaming import wants_stream, stream_ndjson
+from jobs.nexus_flow_lukning import execute_lukning, execute_lukning_batch
 
 logger = logging.getLogger(__name__)
 nexus_client = NexusClient(NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL)
@@ -53,3 +54,19 @@ def _execute_lukning():
     except Exception as e:
         logger.error(f"Failed to execute lukning: {e}")
         return jsonify({"error": "An error occurred while executing lukning"}), 500
+
+
+@api_nexus_bp.route('/execute-lukning/batch', methods=['POST'])
+def _execute_lukning_batch():
+    data = request.get_json()
+    cprs = data.get('cprs')
+    if not cprs or not isinstance(cprs, list):
+        return jsonify({"error": "cprs is required and must be a list"}), 400
+    if wants_stream(request, data):
+        return stream_ndjson(lambda emit: execute_lukning_batch(cprs, on_result=lambda result: emit({'type': 'citizen', **result})))
+    try:
+        summary = execute_lukning_batch(cprs)
+        return jsonify(summary), 200
+    except Exception as e:
+        logger.error(f"Failed to execute lukning batch: {e}")
+        return jsonify({"error": "An error occurred while executing lukning batch"}), 500
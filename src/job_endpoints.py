@@ -1,9 +1,10 @@
+import inspect
 import importlib
 import logging
-import time
 
-from datetime import timedelta
 from flask import Blueprint, request, jsonify
+from job_runner import job_runner, SKIP_IF_RUNNING, SKIPPED
+from utils.streaming import wants_stream, stream_ndjson
 
 
 logger = logging.getLogger(__name__)
@@ -20,6 +21,36 @@ def get_job(job_name):
         return None
 
 
+# Concurrency policy for runs of the same job, set with CONCURRENCY_POLICY in the job module: "skip-if-running" (default), "queue" or "allow"
+def get_job_policy(job_name):
+    try:
+        module = importlib.import_module(f'jobs.{job_name.replace("-", "_")}')
+        return getattr(module, 'CONCURRENCY_POLICY', SKIP_IF_RUNNING)
+    except ImportError:
+        return SKIP_IF_RUNNING
+
+
+# Returns the payload keys (except "start") that are parameters of the job
+def get_job_kwargs(job, payload):
+    parameters = inspect.signature(job).parameters
+    return {key: value for key, value in payload.items() if key not in ['start', 'on_progress'] and key in parameters}
+
+
+def accepts_progress(job):
+    return 'on_progress' in inspect.signature(job).parameters
+
+
+def submit_job(job_name, job, kwargs, on_progress=None):
+    return job_runner.submit(job_name, job, kwargs, policy=get_job_policy(job_name), on_progress=on_progress, accepts_progress=accepts_progress(job))
+
+
+def job_summary(record):
+    summary = {'success': record.success, 'job_id': record.id, 'status': record.status}
+    if record.message:
+        summary['message'] = record.message
+    return summary
+
+
 # endpoints are module names in jobs but with dashes instead of underscores. E.g. nexus_flow_brugerauth.py -> nexus-flow-brugerauth
 @job_api_bp.route('/jobs/<job_name>', methods=['POST'])
 def start_job(job_name):
@@ -45,22 +76,34 @@ def start_job(job_name):
 
         job = get_job(job_name)
         if job:
-            logger.info(f'Starting job: {job_name}')
-            start = time.time()
-            if job():
-                logger.info(f'Finished job: {job_name} in {str(timedelta(seconds=time.time() - start))}')
-                return jsonify({
-                    'success': True,
-                    'message': f'{job_name} finished',
-                    'time': str(timedelta(seconds=time.time() - start))
-                }), 200
-            else:
-                logger.error(f'Failed job: {job_name} in {str(timedelta(seconds=time.time() - start))}')
+            kwargs = get_job_kwargs(job, payload)
+
+            # Stream a NDJSON record per processed item and a final summary, with the job's own summary when it returns a dict
+            if wants_stream(request, payload):
+                def run(emit):
+                    record = submit_job(job_name, job, kwargs, on_progress=emit)
+                    record.wait()
+                    return {**(record.result if isinstance(record.result, dict) else {}), **job_summary(record)}
+                return stream_ndjson(run)
+
+            record = submit_job(job_name, job, kwargs)
+            if record.status == SKIPPED:
+                return jsonify(job_summary(record)), 409
+
+            # "wait": true runs the job to the end before responding
+            if payload.get('wait') is True:
+                record.wait()
                 return jsonify({
-                    'success': False,
-                    'message': f'{job_name} failed',
-                    'time': str(timedelta(seconds=time.time() - start))
-                }), 500
+                    **job_summary(record),
+                    'message': record.message or f'{job_name} {"finished" if record.success else "failed"}',
+                    'time': record.to_dict()['time']
+                }), 200 if record.success else 500
+
+            return jsonify({
+                **job_summary(record),
+                'message': f'{job_name} started',
+                'status_url': f'/jobs/{record.id}'
+            }), 202
         else:
             return jsonify({
                 'success': False,
@@ -71,3 +114,15 @@ def start_job(job_name):
             'success': False,
             'message': str(e)
         }), 500
+
+
+# Status, progress, duration and result of a job run started with POST /jobs/<job_name>
+@job_api_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    record = job_runner.get(job_id)
+    if not record:
+        return jsonify({
+            'success': False,
+            'message': f'Unknown job id: {job_id}'
+        }), 404
+    return jsonify(record.to_dict()), 200
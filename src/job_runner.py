@@ -0,0 +1,155 @@
+import time
+import uuid
+import logging
+import threading
+import collections
+
+from datetime import datetime, timedelta
+
+from utils.config import JOB_HISTORY_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Concurrency policies for runs of the same job name
+SKIP_IF_RUNNING = 'skip-if-running'
+QUEUE = 'queue'
+ALLOW = 'allow'
+POLICIES = [SKIP_IF_RUNNING, QUEUE, ALLOW]
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class JobRecord:
+    def __init__(self, name, policy):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.policy = policy
+        self.status = QUEUED
+        self.created = datetime.now()
+        self.started = None
+        self.finished = None
+        self.progress = 0
+        self.last_progress = None
+        self.result = None
+        self.message = None
+        self._done = threading.Event()
+
+    @property
+    def success(self):
+        return self.status == SUCCEEDED
+
+    @property
+    def duration(self):
+        if not self.started:
+            return None
+        return ((self.finished or datetime.now()) - self.started).total_seconds()
+
+    def is_active(self):
+        return self.status in [QUEUED, RUNNING]
+
+    # Waits until the job has finished or was skipped, returns False on timeout
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'policy': self.policy,
+            'status': self.status,
+            'success': self.success,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'time': str(timedelta(seconds=self.duration)) if self.duration is not None else None,
+            'progress': self.progress,
+            'last_progress': self.last_progress,
+            'result': self.result,
+            'message': self.message
+        }
+
+
+# In-process job executor, every run gets a job id and its status is kept in a bounded in-memory history
+class JobRunner:
+    def __init__(self, max_history=JOB_HISTORY_SIZE):
+        self.max_history = max_history
+        self.records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            return self.records.get(job_id)
+
+    def active(self, name):
+        with self._lock:
+            return [record for record in self.records.values() if record.name == name and record.is_active()]
+
+    # Starts job(**kwargs) in a background thread according to the concurrency policy of the job name
+    # on_progress is called with each progress record the job emits, if the job takes an on_progress argument
+    def submit(self, name, job, kwargs=None, policy=SKIP_IF_RUNNING, on_progress=None, accepts_progress=False):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown concurrency policy: {policy}')
+
+        record = JobRecord(name, policy)
+        with self._lock:
+            running = [other for other in self.records.values() if other.name == name and other.is_active()]
+            if policy == SKIP_IF_RUNNING and running:
+                record.status = SKIPPED
+                record.message = f'{name} is already running as {running[0].id}'
+                record._done.set()
+            self._add(record)
+
+        if record.status == SKIPPED:
+            logger.info(record.message)
+            return record
+
+        # A queued run starts when the runs active at submit time have finished, those are queued behind their predecessors in turn
+        waits_for = running if policy == QUEUE else []
+        threading.Thread(target=self._run, args=(record, job, kwargs or {}, on_progress, accepts_progress, waits_for), daemon=True).start()
+        return record
+
+    def _add(self, record):
+        self.records[record.id] = record
+        # Evict the oldest finished records
+        while len(self.records) > self.max_history:
+            oldest = next((job_id for job_id, other in self.records.items() if not other.is_active()), None)
+            if oldest is None:
+                break
+            del self.records[oldest]
+
+    def _run(self, record, job, kwargs, on_progress, accepts_progress, waits_for):
+        def progress(progress_record):
+            record.progress += 1
+            record.last_progress = progress_record
+            if on_progress:
+                on_progress(progress_record)
+
+        if accepts_progress:
+            kwargs = {**kwargs, 'on_progress': progress}
+
+        for other in waits_for:
+            other.wait()
+        try:
+            record.status = RUNNING
+            record.started = datetime.now()
+            logger.info(f'Starting job: {record.name} ({record.id})')
+            start = time.time()
+            result = job(**kwargs)
+            record.status = SUCCEEDED if (result.get('success', True) if isinstance(result, dict) else result) else FAILED
+            if isinstance(result, (dict, list, str, int, float, bool)):
+                record.result = result
+            logger.info(f'{"Finished" if record.success else "Failed"} job: {record.name} ({record.id}) in {str(timedelta(seconds=time.time() - start))}')
+        except Exception as e:
+            logger.error(f'Error in job {record.name} ({record.id}): {e}')
+            record.status = FAILED
+            record.message = str(e)
+        finally:
+            record.finished = datetime.now()
+            record._done.set()
+
+
+job_runner = JobRunner()
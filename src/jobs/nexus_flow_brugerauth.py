@@ -1,104 +1,264 @@
+import time
 import logging
 
-from utils.config import DELTA_CERT_BASE64, DELTA_CERT_PASS, DELTA_BASE_URL, DELTA_TOP_ADM_UNIT_UUID, NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils.config import DELTA_CERT_BASE64, DELTA_CERT_PASS, DELTA_BASE_URL, DELTA_TOP_ADM_UNIT_UUID, NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL, BRUGERAUTH_MAX_WORKERS, \
+    NEXUS_RESOURCE_CACHE_TTL_SECONDS
+from utils.keyed_lock import KeyedLock
+from utils.conditional_cache import ConditionalResourceCache
 from delta import DeltaClient
-from nexus.nexus_client import NexusClient, NexusRequest, execute_nexus_flow
+from nexus.nexus_client import NexusClient, NexusRequest, execute_nexus_flow, nexus_resource_scope
 
 logger = logging.getLogger(__name__)
+
+# A run is skipped while another is in progress, both would process the same Delta changes
+CONCURRENCY_POLICY = 'skip-if-running'
+
+# Every 25 minutes, each run resumes from the change cursor committed by the last run so no change is missed whatever the interval.
+# Without DELTA_STATE_DIR there is no cursor and get_employees_changed looks back 30 minutes, which still overlaps the interval with jitter
+SCHEDULE = {'interval': 25 * 60, 'jitter': 60, 'misfire_grace': 300}
+
 nexus_client = NexusClient(NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL)
 delta_client = DeltaClient(cert_base64=DELTA_CERT_BASE64, cert_pass=DELTA_CERT_PASS, base_url=DELTA_BASE_URL, top_adm_org_uuid=DELTA_TOP_ADM_UNIT_UUID)
 
+# Serialises updates of the same professional across the worker threads
+professional_locks = KeyedLock()
+
+# Active organisations tree and suppliers between runs, and the index built from their versions
+resource_cache = ConditionalResourceCache(NEXUS_RESOURCE_CACHE_TTL_SECONDS)
+_active_organisation_index = {}
+
 
-def job():
+# Runs on at most max_workers threads with one task per professional, a DQ number that occurs more than once in the changes is
+# planned and applied in the order of the changes under one lock, so each plan is made from the state left by the previous apply.
+# With dry_run the plans are returned without applying them or committing the change cursor.
+# on_progress is called with a record for each processed employee.
+# The change cursor is always committed, the changes of failed employees are kept in it and retried by a bounded number of later runs.
+# Returns a summary with the changes, result and time per employee
+def job(dry_run: bool = False, max_workers: int = BRUGERAUTH_MAX_WORKERS, on_progress=None):
     try:
-        active_org_list = _fetch_all_active_organisations()
+        start = time.time()
+        active_org_index = _get_active_organisation_index()
         all_delta_orgs = delta_client.get_all_organizations()
         employees_changed_list = delta_client.get_employees_changed()
+        total = len(employees_changed_list)
+
+        indexes_by_user = {}
         for index, employee in enumerate(employees_changed_list):
-            logger.info(f"Processing employee {index + 1}/{len(employees_changed_list)}")
-            execute_brugerauth(active_org_list, employee['user'], employee['organizations'], all_delta_orgs)
-        return True
+            indexes_by_user.setdefault(employee['user'], []).append(index)
+
+        plans = [None] * total
+        results = [None] * total
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_process_professional, active_org_index, user, [(index, employees_changed_list[index]) for index in indexes],
+                                       all_delta_orgs, dry_run) for user, indexes in indexes_by_user.items()]
+            completed = 0
+            for future in as_completed(futures):
+                for index, plan, result in future.result():
+                    completed += 1
+                    plans[index] = plan
+                    results[index] = result
+                    logger.info(f"{'Planned' if dry_run else 'Processed'} employee {completed}/{total}")
+                    if on_progress:
+                        on_progress({'type': 'employee', 'index': index + 1, 'total': total, **result})
+
+        failed_employees = [employees_changed_list[index] for index, result in enumerate(results) if not result['success']]
+        failed = len(failed_employees)
+        if not dry_run:
+            delta_client.commit_change_cursor(failed_employees)
+
+        return {
+            'success': True,
+            'dry_run': dry_run,
+            'total': total,
+            'changed': len([plan for plan in plans if not plan.is_empty()]),
+            'succeeded': total - failed,
+            'failed': failed,
+            'time': str(timedelta(seconds=time.time() - start)),
+            'results': results
+        }
     except Exception as e:
         logger.error(f"Error in job: {e}")
         return False
 
 
-def execute_brugerauth(active_org_list: list, primary_identifier: str, input_organisation_uuid_list: list, all_organisation_uuid_list: list = None):
-    print(all_organisation_uuid_list)
-    professional = _fetch_professional(primary_identifier)
+# Plans and applies the changes of one professional in order while holding its lock, returns (index, plan, result) per change
+def _process_professional(active_org_index, user, indexed_employees, all_delta_orgs, dry_run):
+    processed = []
+    with professional_locks(user):
+        for index, employee in indexed_employees:
+            plan = _plan_employee(active_org_index, employee, all_delta_orgs)
+            processed.append((index, plan, _apply_employee(plan, dry_run)))
+    return processed
+
+
+def _plan_employee(active_org_index, employee, all_delta_orgs):
+    start = time.time()
+    with nexus_resource_scope():
+        try:
+            plan = plan_brugerauth(active_org_index, employee['user'], employee['organizations'], all_delta_orgs)
+        except Exception as e:
+            logger.error(f"Error planning employee {employee['user']}: {e}")
+            plan = BrugerauthPlan(employee['user'])
+            plan.error = str(e)
+    plan.time = time.time() - start
+    return plan
+
+
+def _apply_employee(plan, dry_run):
+    start = time.time()
+    # Applied in a new scope, so the updates are made from fresh reads, like the configuration that is PUT with the supplier
+    with nexus_resource_scope():
+        try:
+            success = plan.error is None if dry_run else apply_brugerauth(plan)
+        except Exception as e:
+            logger.error(f"Error processing employee {plan.user}: {e}")
+            success = False
+    return {'user': plan.user, 'success': bool(success), 'changes': plan.to_dict(), 'time': str(timedelta(seconds=plan.time + time.time() - start))}
+
+
+# Lookups over the cached active organisations and their suppliers, built by _get_active_organisation_index when they change
+class ActiveOrganisationIndex:
+    def __init__(self, active_org_list: list):
+        self.ids_by_sync_id = {}
+        self.supplier_by_id = {}
+        for org in active_org_list:
+            self.ids_by_sync_id.setdefault(org['sync_id'], []).append(org['id'])
+            self.supplier_by_id.setdefault(org['id'], org.get('supplier'))
+
+    # Nexus ids of the organisations with the given sync ids (Delta uuids)
+    def ids_for(self, sync_ids) -> set:
+        return {org_id for sync_id in sync_ids for org_id in self.ids_by_sync_id.get(sync_id, [])}
+
+    # Supplier of the first organisation with the sync id
+    def supplier_for(self, sync_id):
+        org_ids = self.ids_by_sync_id.get(sync_id)
+        return self.supplier_by_id.get(org_ids[0]) if org_ids else None
+
+
+# Changes for one professional: create it from the external system, organisation ids to add and remove, and the default supplier to set
+class BrugerauthPlan:
+    def __init__(self, user):
+        self.user = user
+        self.professional = None
+        self.external_professional = None
+        self.add = []
+        self.remove = []
+        self.supplier = None
+        self.error = None
+        self.time = 0
+
+    @property
+    def create(self):
+        return self.external_professional is not None
+
+    def is_empty(self):
+        return not (self.create or self.add or self.remove or self.supplier)
+
+    def to_dict(self):
+        return {
+            'create': self.create,
+            'add': self.add,
+            'remove': self.remove,
+            'supplier': self.supplier.get('id') if isinstance(self.supplier, dict) else self.supplier,
+            'error': self.error
+        }
+
+
+# Reads the current state of the professional and returns the changes that bring it in line with its Delta organisations
+def plan_brugerauth(active_org_index: ActiveOrganisationIndex, primary_identifier: str, input_organisation_uuid_list: list, all_organisation_uuid_list: list = None):
+    plan = BrugerauthPlan(primary_identifier)
+    organisation_ids_to_assign = active_org_index.ids_for(input_organisation_uuid_list)
+    if len(organisation_ids_to_assign) == 0:
+        # TODO: Reomve ? or return None?
+        logger.error(f"No organizations found for professional {primary_identifier}")
+
+    # Get top organisation's supplier
+    supplier = active_org_index.supplier_for(input_organisation_uuid_list[0]) if input_organisation_uuid_list else None
 
-    if not professional:
+    plan.professional = _fetch_professional(primary_identifier)
+    if not plan.professional:
         logger.info(f"Professional {primary_identifier} not found in Nexus - creating")
         # TODO: Add filtering for which professionals to create
-        new_professional = _fetch_external_professional(primary_identifier)
-        if new_professional:
-            professional = nexus_client.post_request(professional['_links']['create']['href'], json=professional)
+        plan.external_professional = _fetch_external_professional(primary_identifier)
+        if not plan.external_professional:
+            plan.error = f"Professional {primary_identifier} not found in external system - skipping"
+            logger.error(plan.error)
+            return plan
+        plan.add = sorted(organisation_ids_to_assign)
+        plan.supplier = supplier
+        return plan
+
+    # Get all assigned organisations for professional as list of dicts with id and sync_id
+    professional_org_ids = {item['id'] for item in _fetch_professional_org_syncIds(plan.professional)}
+
+    # IDs not already assigned to the professional
+    plan.add = sorted(organisation_ids_to_assign - professional_org_ids)
+
+    # Nexus ids of all delta uuids which are not set for the user, that are assigned to the professional
+    uuids_to_remove = set(all_organisation_uuid_list or []) - set(input_organisation_uuid_list)
+    plan.remove = sorted(active_org_index.ids_for(uuids_to_remove) & professional_org_ids)
+
+    # Only set the supplier if the professional has none
+    if supplier and not _fetch_professional_configuration(plan.professional).get('defaultOrganizationSupplier'):
+        plan.supplier = supplier
+    return plan
+
+
+# Applies the non-empty changes of a plan, returns True if the professional is up to date
+def apply_brugerauth(plan: BrugerauthPlan):
+    primary_identifier = plan.user
+    if plan.error:
+        return False
+    if plan.is_empty():
+        logger.info(f'Professional {primary_identifier} already up to date - not updating')
+        return True
+
+    try:
+        professional = plan.professional
+        if plan.create:
+            professional = nexus_client.post_request(plan.external_professional['_links']['create']['href'], json=plan.external_professional)
             if professional:
                 logger.info(f"Professional {primary_identifier} created")
             else:
                 logger.error(f"Failed to create professional {primary_identifier} - skipping")
-                return
-        else:
-            logger.error(f"Professional {primary_identifier} not found in external system - skipping")
-            return
-
-    # Get all assigned organisations for professional as list of dicts - [0] being id, [1] being uuid
-    professional_org_list = _fetch_professional_org_syncIds(professional)
-    # logger.info(f"Professional current organisation: {professional_org_list}")
-
-    # uuids from active_org_list not found in input_organisation_uuid_list
-    organisation_ids_to_assign = [item['id'] for item in active_org_list if item['sync_id'] in input_organisation_uuid_list]
-
-    if len(organisation_ids_to_assign) == 0:
-        # TODO: Reomve ? or return None?
-        logger.error(f"No organizations found for professional {primary_identifier}")
-
-    # Filter out IDs present in professional_org_list
-    unassigned_organisation_ids_to_assign = [org_id for org_id in organisation_ids_to_assign if org_id not in [item['id'] for item in professional_org_list]]
+                return False
 
-    # Remove duplicates
-    unassigned_organisation_ids_to_assign = list(set(unassigned_organisation_ids_to_assign))
-
-    # Get a list of all delta uuid which are not set for the user and get corosponding nexus ids
-    uuids_to_remove = list(set(all_organisation_uuid_list) - set(input_organisation_uuid_list))
-    organisation_ids_to_remove = [item['id'] for item in active_org_list if item['sync_id'] in uuids_to_remove]
-
-    # Filter out IDs not present in professional_org_list and remove duplicates
-    assigned_organisation_ids_to_remove = [org_id for org_id in organisation_ids_to_remove if org_id in [item['id'] for item in professional_org_list]]
-    assigned_organisation_ids_to_remove = list(set(assigned_organisation_ids_to_remove))
-
-    try:
-        if len(unassigned_organisation_ids_to_assign) > 0:
+        success = True
+        if plan.add or plan.remove:
             # Update the organisations for the professional
-            if _update_professional_organisations(professional, unassigned_organisation_ids_to_assign, assigned_organisation_ids_to_remove):
+            if _update_professional_organisations(professional, plan.add, plan.remove):
                 logger.info(f'Professional {primary_identifier} updated with organisations')
             else:
                 logger.error(f'Failed to update professional {primary_identifier} with organisations')
-        else:
-            logger.info(f'Professional {primary_identifier} already has all organisations - not updating')
-
-        # Get top organisation's supplier
-        current = next((item for item in active_org_list if item['sync_id'] == input_organisation_uuid_list[0]), None)
-        supplier = current.get('supplier')
+                success = False
 
-        # If it has a supplier update it
-        if supplier:
-            if _update_professional_supplier(professional, supplier, primary_identifier):
+        if plan.supplier:
+            if _update_professional_supplier(professional, plan.supplier, primary_identifier):
                 logger.info(f"Professional {primary_identifier} updated with supplier")
             else:
                 logger.error(f"Failed to update professional {primary_identifier} with supplier")
-        else:
-            logger.info(f'Top organisation for professional {primary_identifier} has a  no supplier - not updating')
+                success = False
 
         logger.info(f'Professional {primary_identifier} updated sucessfully')
+        return success
     except Exception as e:
         logger.error(f'Failed to update professional {primary_identifier}: {e}')
+        return False
+
+
+# Returns True if the professional is up to date, False if it could not be created or updated
+def execute_brugerauth(active_org_index: ActiveOrganisationIndex, primary_identifier: str, input_organisation_uuid_list: list, all_organisation_uuid_list: list = None):
+    return apply_brugerauth(plan_brugerauth(active_org_index, primary_identifier, input_organisation_uuid_list, all_organisation_uuid_list))
 
 
 def _fetch_professional(primary_identifier):
     # Find professional by query
-    if len(nexus_client.find_professional_by_query(primary_identifier)) > 0:
-        return nexus_client.find_professional_by_query(primary_identifier)[0]
+    professionals = nexus_client.find_professional_by_query(primary_identifier)
+    if len(professionals) > 0:
+        return professionals[0]
 
 
 def _fetch_external_professional(primary_identifier):
@@ -139,14 +299,18 @@ def _update_professional_organisations(professional, organisation_ids_to_add, or
     return professional_org_change_list
 
 
-def _update_professional_supplier(professional, supplier, primary_identifier):
+def _fetch_professional_configuration(professional):
     # Professional self
-    request = NexusRequest(input_response=professional, link_href="self", method="GET")
-    professional_self = execute_nexus_flow([request])
+    request1 = NexusRequest(input_response=professional, link_href="self", method="GET")
 
     # Professional configuration
-    request = NexusRequest(input_response=professional_self, link_href="configuration", method="GET")
-    professional_config = execute_nexus_flow([request])
+    request2 = NexusRequest(link_href="configuration", method="GET")
+
+    return execute_nexus_flow([request1, request2])
+
+
+def _update_professional_supplier(professional, supplier, primary_identifier):
+    professional_config = _fetch_professional_configuration(professional)
 
     # Only update supplier if it is None/null
     if not professional_config.get('defaultOrganizationSupplier'):
@@ -155,6 +319,7 @@ def _update_professional_supplier(professional, supplier, primary_identifier):
         return execute_nexus_flow([request])
     else:
         logger.info(f'Professional {primary_identifier} already has a supplier - not updating')
+        return True
 
 
 def _fetch_professional_org_syncIds(professional):
@@ -175,20 +340,34 @@ def _fetch_professional_org_syncIds(professional):
     return _collect_syncIds_from_list_or_org(professional_org_list)
 
 
-def _fetch_all_active_organisations():
-    # Home resource
-    home_resource = nexus_client.home_resource()
+# Returns the ActiveOrganisationIndex, rebuilt only when the active organisations or suppliers have changed in Nexus
+def _get_active_organisation_index():
+    organisations, suppliers = _fetch_active_organisations_and_suppliers()
+    versions = (organisations.version, suppliers.version)
+    if _active_organisation_index.get('versions') != versions:
+        _active_organisation_index['index'] = ActiveOrganisationIndex(_add_supplier_ids(organisations.index, suppliers.index))
+        _active_organisation_index['versions'] = versions
+    else:
+        logger.info("Active organisations and suppliers unchanged - reusing index")
+    return _active_organisation_index['index']
 
-    # Active organisations
-    request1 = NexusRequest(input_response=home_resource, link_href="activeOrganizationsTree", method="GET")
-    # Suppliers
-    request2 = NexusRequest(input_response=home_resource, link_href="suppliers", method="GET")
 
-    all_active_organisations = execute_nexus_flow([request1])
-    all_suppliers = execute_nexus_flow([request2])
+def _get_cached_home_link(rel, build=None):
+    href = nexus_client.get_home_link(rel)
+    if not href:
+        raise Exception(f"Link '{rel}' not found in home resource")
+    resource = resource_cache.get(nexus_client.api_client, href, build)
+    if resource is None:
+        raise Exception(f"Failed to fetch {rel}")
+    return resource
 
-    organisation_ids = _collect_syncIds_from_list_or_org(all_active_organisations)
-    return _add_supplier_ids(organisation_ids, all_suppliers)
+
+def _fetch_active_organisations_and_suppliers():
+    # Active organisations and suppliers are fetched concurrently, the flattened organisation tree is cached as the index of the tree
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        organisations = executor.submit(_get_cached_home_link, 'activeOrganizationsTree', _collect_syncIds_from_list_or_org)
+        suppliers = executor.submit(_get_cached_home_link, 'suppliers', _index_suppliers)
+        return organisations.result(), suppliers.result()
 
 
 def _collect_syncIds_from_list_or_org(org_input):
@@ -203,30 +382,43 @@ def _collect_syncIds_from_list_or_org(org_input):
 def _collect_syncIds_from_list(org_list: list):
     # Collect syncIds from a list of organizations.
 
-    sync_ids = []
-    for org in org_list:
-        sync_ids.extend(_collect_syncIds_and_ids_from_org(org))
-    return sync_ids
+    return [sync_id_and_id for org in org_list for sync_id_and_id in _collect_syncIds_and_ids_from_org(org)]
 
 
 def _collect_syncIds_and_ids_from_org(org: object):
-    # Recursively collects syncIds and ids from an organization and its children.
-    sync_ids_and_ids = []
-    if isinstance(org, dict):
-        if 'syncId' in org and org['syncId'] is not None:
-            sync_ids_and_ids.append({'id': org['id'], 'sync_id': org['syncId']})
-        for child in org.get('children', []):
-            sync_ids_and_ids.extend(_collect_syncIds_and_ids_from_org(child))
-    else:
-        logger.info(f"Unexpected type for org: {type(org)}")
-    return sync_ids_and_ids
-
-
-def _add_supplier_ids(organisation_ids: list, suppliers: list):
-    for sup in suppliers:
-        if type(sup) is str:
-            print(sup)
-    for org in organisation_ids:
-        supplier = next((item for item in suppliers if item.get('organizationId') == org['id']), None)
-        org['supplier'] = supplier
-    return organisation_ids
+    # Yields syncIds and ids from an organization and its children in pre-order.
+    # Iterative with an explicit stack, so deep trees neither recurse nor copy lists per level.
+    stack = [org]
+    while stack:
+        org = stack.pop()
+        if not isinstance(org, dict):
+            logger.info(f"Unexpected type for org: {type(org)}")
+            continue
+        if org.get('syncId') is not None:
+            yield {'id': org['id'], 'sync_id': org['syncId']}
+        stack.extend(reversed(org.get('children') or []))
+
+
+def _index_suppliers(suppliers: list):
+    # Suppliers by organizationId. Organisations with more than one supplier are reported and keep the first one.
+    suppliers_by_org_id = {}
+    duplicates = {}
+    for supplier in suppliers:
+        if not isinstance(supplier, dict):
+            logger.warning(f"Unexpected supplier: {supplier}")
+            continue
+        org_id = supplier.get('organizationId')
+        if org_id is None:
+            continue
+        if org_id in suppliers_by_org_id:
+            duplicates.setdefault(org_id, [suppliers_by_org_id[org_id].get('id')]).append(supplier.get('id'))
+        else:
+            suppliers_by_org_id[org_id] = supplier
+    if duplicates:
+        logger.warning(f"{len(duplicates)} organisations have more than one supplier, using the first - supplier ids by organisation id: {duplicates}")
+    return suppliers_by_org_id
+
+
+def _add_supplier_ids(organisation_ids: list, suppliers_by_org_id: dict):
+    # New dicts, the organisation ids may be the cached index of the organisation tree
+    return [{**org, 'supplier': suppliers_by_org_id.get(org['id'])} for org in organisation_ids]
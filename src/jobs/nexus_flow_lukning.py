@@ -1,32 +1,110 @@
+import time
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from nexus.nexus_client import NexusClient, NexusRequest, execute_nexus_flow
-from utils.config import NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL
+from nexus.nexus_flow import NexusFlowNode, execute_nexus_dag
+from utils.config import NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL, LUKNING_MAX_WORKERS, LUKNING_PARALLEL_PHASES, LUKNING_BATCH_MAX_WORKERS
 
 logger = logging.getLogger(__name__)
 nexus_client = NexusClient(NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL)
 
 
-def execute_lukning(cpr: str):
+# Sizes the nested pools (citizens, phases and pathway items) from the connection pool to Nexus instead of multiplying them.
+# Returns the number of citizens to close concurrently and the pathway item workers of each citizen
+def _lukning_workers(citizens: int, batch_workers: int = 1, max_workers: int = LUKNING_MAX_WORKERS, parallel_phases: bool = LUKNING_PARALLEL_PHASES):
+    pool_size = nexus_client.api_client.session_pool.maxsize_for(NEXUS_URL)
+    other_phases = 2 if parallel_phases else 0
+    # Every citizen needs a connection for each of its other phases and at least one for the pathway items
+    batch_workers = max(1, min(batch_workers, citizens, pool_size // (other_phases + 1)))
+    pathway_workers = max(1, min(max_workers, pool_size // batch_workers - other_phases))
+    return batch_workers, pathway_workers
+
+
+# Returns a report with 'success', a 'message' on failure and the outcome and time of each phase
+# With parallel_phases the independent phases (calendar events, conditions and pathways) run concurrently
+def execute_lukning(cpr: str, max_workers: int = LUKNING_MAX_WORKERS, parallel_phases: bool = LUKNING_PARALLEL_PHASES):
     afslutning_af_borger_dashboard_id = 6866
+    start = time.time()
+    _, max_workers = _lukning_workers(1, max_workers=max_workers, parallel_phases=parallel_phases)
+    report = {'success': False}
     try:
         # Find patient by CPR
         patient = nexus_client.fetch_patient_by_query(query=cpr)
         if not patient:
             logger.error("Patient not found.")
-            return
+            report['message'] = "Patient not found"
+            return report
         dashboard = nexus_client.fetch_dashboard(patient, afslutning_af_borger_dashboard_id)
         if not dashboard:
             logger.error("Dashboard not found.")
-            return
-
-        _cancel_events(patient)
-        _set_conditions_inactive(patient)
-        _set_pathways_inactive(patient)
+            report['message'] = "Dashboard not found"
+            return report
+
+        phases = [
+            ('cancel_events', _cancel_events, (patient,)),
+            ('conditions', _set_conditions_inactive, (patient,)),
+            ('pathways', _set_pathways_inactive, (dashboard, max_workers))
+        ]
         # _remove_patient_grants([2298969])
+        if parallel_phases:
+            with ThreadPoolExecutor(max_workers=len(phases)) as executor:
+                phase_reports = list(executor.map(lambda phase: _run_phase(*phase), phases))
+        else:
+            phase_reports = [_run_phase(*phase) for phase in phases]
+
+        report['phases'] = {name: phase_report for (name, _, _), phase_report in zip(phases, phase_reports)}
+        report['success'] = all(phase_report['success'] for phase_report in phase_reports)
 
     except Exception as e:
         logger.error(f"Error in job: {e}")
+        report['message'] = str(e)
+    report['time'] = str(timedelta(seconds=time.time() - start))
+    return report
+
+
+# Closes many citizens on a worker pool, the home resource and its links are cached and shared by all workers.
+# The pathway workers of each citizen are sized so the whole batch stays within the Nexus connection pool
+# on_result is called with the result of each citizen as it completes. Returns a summary with the results in input order
+def execute_lukning_batch(cprs: list, max_workers: int = LUKNING_BATCH_MAX_WORKERS, on_result=None):
+    start = time.time()
+    results = [None] * len(cprs)
+    max_workers, pathway_workers = _lukning_workers(len(cprs), max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(execute_lukning, cpr, pathway_workers): index for index, cpr in enumerate(cprs)}
+        for completed, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                report = {'success': False, 'message': str(e)}
+            results[index] = {'cpr': cprs[index], **report}
+            logger.info(f"Lukning {completed}/{len(cprs)} done - {'succeeded' if report['success'] else 'failed'}")
+            if on_result:
+                on_result(results[index])
+
+    failed = len([result for result in results if not result['success']])
+    return {
+        'success': failed == 0,
+        'total': len(results),
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'time': str(timedelta(seconds=time.time() - start)),
+        'results': results
+    }
+
+
+# Runs a lukning phase and returns its outcome and time, a dict returned by the phase is added to the outcome
+def _run_phase(name, phase, args):
+    start = time.time()
+    try:
+        result = phase(*args)
+        phase_report = dict(result) if isinstance(result, dict) and 'success' in result else {'success': bool(result)}
+    except Exception as e:
+        logger.error(f"Error in lukning phase {name}: {e}")
+        phase_report = {'success': False, 'error': str(e)}
+    phase_report['time'] = str(timedelta(seconds=time.time() - start))
+    return phase_report
 
 
 def _cancel_events(patient):
@@ -51,7 +129,7 @@ def _cancel_events(patient):
         # If list is empty, stopEvents request will time out
         if not event_ids:
             logger.info("No events to cancel.")
-            return
+            return True
 
         # Cancel events request
         request1 = NexusRequest(input_response=events_list,
@@ -89,7 +167,7 @@ def _set_conditions_inactive(patient):
 
         if not active_conditions_ids:
             logger.info("No active conditions found.")
-            return
+            return True
 
         # Convert list of ids to a comma-separated string
         condition_ids_str = ','.join(map(str, active_conditions_ids))
@@ -135,10 +213,12 @@ def _set_conditions_inactive(patient):
         logger.error(f"Error setting conditions inactive: {e}")
 
 
-def _set_pathways_inactive(dashboard):
+set_pathway_inactive_action_id = [30504, 37102]
+
+
+def _set_pathways_inactive(dashboard, max_workers: int = LUKNING_MAX_WORKERS):
     try:
         pathway_collection_header_title = ["Alle borgers Handlingsanvisninger", "Skemaer - afslutning af borger"]
-        set_pathway_inactive_action_id = [30504, 37102]
         exclude_pathway_names = ["Akutkald"]
 
         # Fetch the pathway collection matching the header title
@@ -149,76 +229,69 @@ def _set_pathways_inactive(dashboard):
             logger.error("No pathway collections matching the header titles found.")
             return False
 
-        # Iterate over the pathway collection, and find pathway references
-        for pathway in patient_pathway_collection:
-
-            # Check if the pathway has patient activities
+        # Patient activities and pathway references of every pathway collection, fetched concurrently
+        nodes = []
+        for index, pathway in enumerate(patient_pathway_collection):
             if 'patientActivities' in pathway['_links']:
-                # Patient activities
-                request1 = NexusRequest(input_response=pathway,
-                                        link_href="patientActivities",
-                                        method="GET")
-                patient_activities = execute_nexus_flow([request1])
-
-                # Iterate over patient activities, and set status to inactive
-                for activity in patient_activities:
-                    # activity self
-                    request1 = NexusRequest(input_response=activity,
-                                            link_href="self",
-                                            method="GET")
-                    activity_self = execute_nexus_flow([request1])
-
-                    request1 = NexusRequest(input_response=activity_self,
-                                            link_href="availableActions",
-                                            method="GET")
-
-                    available_actions = execute_nexus_flow([request1])
-
-                    # Fetch the inactive action object
-                    inactive_action = next(item for item in available_actions
-                                           if item['id'] in set_pathway_inactive_action_id)
-                    request1 = NexusRequest(input_response=inactive_action,
-                                            link_href="updateFormData",
-                                            method="PUT", payload=activity_self)
-                    execute_nexus_flow([request1])
-
-            # Pathway reference
-            request1 = NexusRequest(input_response=pathway,
-                                    link_href="pathwayReferences",
-                                    method="GET")
-            pathway_references = execute_nexus_flow([request1])
-
-            # Iterate over the pathway references, and set status to inactive
-            for reference in pathway_references:
+                nodes.append(NexusFlowNode(f'activity:{index}', NexusRequest(input_response=pathway, link_href="patientActivities", method="GET")))
+            nodes.append(NexusFlowNode(f'reference:{index}', NexusRequest(input_response=pathway, link_href="pathwayReferences", method="GET")))
+        flow_result = execute_nexus_dag(nodes, max_workers=max_workers)
+
+        items = []
+        for node in nodes:
+            item_type = node.name.split(':')[0]
+            for item in flow_result[node.name]:
                 # Skip pathway that should not be set inactive
-                if reference['name'] in exclude_pathway_names:
-                    logger.info(f"Skipping pathway: {reference['name']}")
+                if item_type == 'reference' and item['name'] in exclude_pathway_names:
+                    logger.info(f"Skipping pathway: {item['name']}")
                     continue
-                # Fetch referenced object of the current pathway
-                request2 = NexusRequest(input_response=reference,
-                                        link_href="referencedObject",
-                                        method="GET")
-                pathway_reference = execute_nexus_flow([request1, request2])
-
-                # Fetch available actions for the current pathway
-                request1 = NexusRequest(input_response=pathway_reference,
-                                        link_href="availableActions",
-                                        method="GET")
-                available_actions = execute_nexus_flow([request1])
-
-                # Fetch the inactive action object
-                inactive_action = next(item for item in available_actions if item['id'] in set_pathway_inactive_action_id)
-                request1 = NexusRequest(input_response=inactive_action,
-                                        link_href="updateFormData",
-                                        method="PUT", payload=pathway_reference)
-                execute_nexus_flow([request1])
-        logger.info("Pathways set to inactive")
-        return True
+                items.append((item_type, item))
+
+        # Set every activity and pathway reference inactive, at most max_workers at a time
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda item: _set_pathway_item_inactive(*item), items))
+
+        failed = [result for result in results if not result['success']]
+        if failed:
+            logger.error(f"Failed to set {len(failed)} of {len(results)} pathways inactive")
+        else:
+            logger.info("Pathways set to inactive")
+        return {'success': not failed, 'total': len(results), 'failed': len(failed), 'items': results}
 
     except Exception as e:
         logger.error(f"Error setting pathways inactive: {e}")
 
 
+# Sets a patient activity or a pathway reference inactive, returns the result of the item
+def _set_pathway_item_inactive(item_type, item):
+    result = {'type': item_type, 'id': item.get('id'), 'name': item.get('name'), 'success': False}
+    try:
+        if item_type == 'activity':
+            # Activity self
+            request1 = NexusRequest(input_response=item, link_href="self", method="GET")
+        else:
+            # Fetch referenced object of the current pathway
+            request1 = NexusRequest(input_response=item, link_href="referencedObject", method="GET")
+        item_self = execute_nexus_flow([request1])
+
+        # Fetch available actions for the current activity or pathway
+        request1 = NexusRequest(input_response=item_self, link_href="availableActions", method="GET")
+        available_actions = execute_nexus_flow([request1])
+
+        # Fetch the inactive action object
+        inactive_action = next((action for action in available_actions if action['id'] in set_pathway_inactive_action_id), None)
+        if inactive_action is None:
+            raise ValueError("Inactive action not found")
+
+        request1 = NexusRequest(input_response=inactive_action, link_href="updateFormData", method="PUT", payload=item_self)
+        execute_nexus_flow([request1])
+        result['success'] = True
+    except Exception as e:
+        logger.error(f"Error setting {item_type} {result['id']} inactive: {e}")
+        result['error'] = str(e)
+    return result
+
+
 def _remove_basket_grants(patient, dashboard):
     pathway_collection_header_title = ["Ikke-visiteret"]
     try:
@@ -279,12 +352,9 @@ def _remove_patient_grants(grant_ids: list):
         # Hardcoded value to open the Afslut window for grants/tilstande
         grant_afslut_id = [418, 502]
 
-        # Home resource
-        home_res = nexus_client.home_resource()
-
         for id in grant_ids:
             # Get patient grant by id
-            patient_grant = nexus_client.get_request(home_res["_links"]["patientGrantById"]["href"] + "/" + str(id))
+            patient_grant = nexus_client.get_home_link_request("patientGrantById", suffix="/" + str(id))
 
             # Fetch afslut object by grant_afslut_id
             afslut_object = next(item for item in patient_grant["currentWorkflowTransitions"]
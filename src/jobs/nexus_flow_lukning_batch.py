@@ -0,0 +1,19 @@
+import logging
+
+from jobs.nexus_flow_lukning import execute_lukning_batch
+
+logger = logging.getLogger(__name__)
+
+# Batches for different citizens may run at the same time
+CONCURRENCY_POLICY = 'allow'
+
+
+# Payload: {"start": true, "cprs": ["<cpr>", ...]}
+# Returns the batch summary with the result of each citizen
+def job(cprs: list = None, on_progress=None):
+    if not cprs:
+        logger.error("No CPRs given for lukning batch")
+        return False
+    summary = execute_lukning_batch(cprs, on_result=(lambda result: on_progress({'type': 'citizen', **result})) if on_progress else None)
+    logger.info(f"Lukning batch: {summary['succeeded']} of {summary['total']} citizens closed in {summary['time']}")
+    return summary
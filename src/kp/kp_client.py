@@ -111,8 +111,8 @@ class KPAPIClient(BaseAPIClient):
             }
             """
             try:
-                response = requests.post(url, headers=headers, data=data,
-                                         auth=HTTPBasicAuth(username=BROWSERLESS_CLIENT_ID, password=BROWSERLESS_CLIENT_SECRET), timeout=180)
+                response = self.session.post(url, headers=headers, data=data,
+                                             auth=HTTPBasicAuth(username=BROWSERLESS_CLIENT_ID, password=BROWSERLESS_CLIENT_SECRET), timeout=180)
             except requests.exceptions.RequestException as e:
                 logger.error("Failed to fetch a response from Browserless: %s", e)
 
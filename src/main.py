@@ -3,8 +3,9 @@ from healthcheck import HealthCheck
 from prometheus_client import generate_latest
 
 from utils.logging import set_logging_configuration, APP_RUNNING
-from utils.config import DEBUG, PORT, POD_NAME
+from utils.config import DEBUG, PORT, POD_NAME, SCHEDULER_ENABLED
 from job_endpoints import job_api_bp
+from scheduler import scheduler
 from endpoints.nexus_endpoints import api_nexus_bp
 from endpoints.kp_endpoints import api_kp_bp
 from endpoints.sbsys_endpoints import api_sbsys_bp
@@ -22,6 +23,8 @@ def create_app():
     app.register_blueprint(api_kp_bp)
     app.register_blueprint(api_sbsys_bp)
     APP_RUNNING.labels(POD_NAME).set(1)
+    if SCHEDULER_ENABLED:
+        scheduler.start()
     return app
 
 
@@ -1,9 +1,15 @@
+import copy
 import logging
 import time
+import threading
+import contextlib
+import contextvars
 import requests
 from typing import Dict, Tuple, List, Optional
+from urllib.parse import urlsplit
 from base_api_client import BaseAPIClient
-from utils.config import NEXUS_URL, NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_TOKEN_ROUTE
+from utils.cache import TTLCache
+from utils.config import NEXUS_URL, NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_TOKEN_ROUTE, NEXUS_HOME_TTL_SECONDS
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +26,9 @@ class NexusAPIClient(BaseAPIClient):
         self.access_token_expiry = None
         self.refresh_token = None
         self.refresh_token_expiry = None
+        # Home resource and its link relations (rel name -> href), shared by all NexusClients using this api client
+        self.home_cache = TTLCache(NEXUS_HOME_TTL_SECONDS)
+        self._token_lock = threading.Lock()
 
     @classmethod
     def get_client(cls, client_id, client_secret, url):
@@ -41,7 +50,7 @@ class NexusAPIClient(BaseAPIClient):
             "Content-Type": "application/x-www-form-urlencoded"
         }
         try:
-            response = requests.post(token_url, headers=headers, data=payload)
+            response = self.session.post(token_url, headers=headers, data=payload)
             response.raise_for_status()
             data = response.json()
             self.access_token = data['access_token']
@@ -65,7 +74,7 @@ class NexusAPIClient(BaseAPIClient):
             "Content-Type": "application/x-www-form-urlencoded"
         }
         try:
-            response = requests.post(token_url, headers=headers, data=payload)
+            response = self.session.post(token_url, headers=headers, data=payload)
             response.raise_for_status()
             data = response.json()
             self.access_token = data['access_token']
@@ -77,13 +86,15 @@ class NexusAPIClient(BaseAPIClient):
             logger.error(e)
             return None
 
+    # Serialised so concurrent requests share one token request
     def authenticate(self):
-        if self.access_token and self.access_token_expiry and time.time() < self.access_token_expiry:
-            return self.access_token
-        elif self.refresh_token and self.refresh_token_expiry and time.time() < self.refresh_token_expiry:
-            return self.refresh_access_token()
-        else:
-            return self.request_access_token()
+        with self._token_lock:
+            if self.access_token and self.access_token_expiry and time.time() < self.access_token_expiry:
+                return self.access_token
+            elif self.refresh_token and self.refresh_token_expiry and time.time() < self.refresh_token_expiry:
+                return self.refresh_access_token()
+            else:
+                return self.request_access_token()
 
     def get_access_token(self):
         return self.authenticate()
@@ -98,35 +109,52 @@ class NexusClient:
     def __init__(self, client_id, client_secret, url):
         self.api_client = NexusAPIClient.get_client(client_id, client_secret, url)
 
+    # Home resource, cached for NEXUS_HOME_TTL_SECONDS
     def home_resource(self):
-        path = "api/core/mobile/randers/v2/"
-        return self.get_request(path)
+        home = self.api_client.home_cache.get('home')
+        if home is None:
+            path = "api/core/mobile/randers/v2/"
+            home = self.get_request(path)
+            if home:
+                self.api_client.home_cache.set('home', home)
+                self.api_client.home_cache.set('links', {rel: link['href'] for rel, link in home.get('_links', {}).items() if 'href' in link})
+        return home
+
+    def invalidate_home_resource(self):
+        self.api_client.home_cache.invalidate()
+
+    # Returns the href of a link relation in the home resource
+    def get_home_link(self, rel):
+        links = self.api_client.home_cache.get('links')
+        if links is None:
+            if not self.home_resource():
+                return None
+            links = self.api_client.home_cache.get('links', {})
+        return links.get(rel)
+
+    # GET on a link relation of the home resource, on 404 the cached home resource is invalidated and the link looked up again
+    def get_home_link_request(self, rel, params=None, suffix=''):
+        for attempt in range(2):
+            link = self.get_home_link(rel)
+            if not link:
+                return None
+            response = self.get_request(link + suffix, params)
+            if response is None and self.api_client.last_status_code == 404 and attempt == 0:
+                logger.info(f"Home link '{rel}' returned 404 - refreshing home resource")
+                self.invalidate_home_resource()
+                continue
+            return response
 
     def find_professional_by_query(self, query):
-        home = self.home_resource()
-
-        if home:
-            {'query': query}
-            professionals_link = home['_links']['professionals']['href']
-            return self.get_request(professionals_link, params={'query': query})
+        return self.get_home_link_request('professionals', params={'query': query})
         # path = "api/core/mobile/randers/v2/professionals/?query=" + query
         # return self.get_request(path)
 
     def find_external_professional_by_query(self, query):
-        home = self.home_resource()
-
-        if home:
-            {'query': query}
-            professionals_link = home['_links']['professionals']['href']
-            return self.get_request(professionals_link, params={'query': query})
+        return self.get_home_link_request('professionals', params={'query': query})
 
     def find_patient_by_query(self, query):
-        home = self.home_resource()
-
-        if home:
-            {'query': query}
-            professionals_link = home['_links']['patients']['href']
-            return self.get_request(professionals_link, params={'query': query})
+        return self.get_home_link_request('patients', params={'query': query})
         # path = "api/core/mobile/randers/v2/patients/?query=" + query
         # return self.api_client.get(path)
 
@@ -203,7 +231,7 @@ class NexusClient:
             logger.error(f"Error in fetching dashboard: {e}")
 
     def get_request(self, path, params=None):
-        return self.api_client.get(path, params)
+        return self.api_client.get(path, params=params)
 
     def post_request(self, path, data=None, json=None):
         return self.api_client.post(path, data, json)
@@ -219,6 +247,47 @@ class NexusClient:
 nexus_client = NexusClient(NEXUS_CLIENT_ID, NEXUS_CLIENT_SECRET, NEXUS_URL)
 
 
+# Memoized GET responses by href for one unit of work, e.g. the processing of one employee.
+# Responses are copied in and out so callers can modify them, and a POST, PUT or DELETE invalidates its url, the resource it was
+# issued from and the parent resources of its url
+class NexusResourceScope:
+    def __init__(self):
+        self.resources = {}
+        self.hits = 0
+
+    def get(self, href):
+        if href in self.resources:
+            self.hits += 1
+            return copy.deepcopy(self.resources[href])
+        return None
+
+    def set(self, href, response):
+        if response is not None:
+            self.resources[href] = copy.deepcopy(response)
+
+    def invalidate(self, href, source_href=None):
+        path = urlsplit(href).path.rstrip('/')
+        for cached_href in list(self.resources):
+            cached_path = urlsplit(cached_href).path.rstrip('/')
+            if cached_href in (href, source_href) or path == cached_path or path.startswith(cached_path + '/'):
+                del self.resources[cached_href]
+
+
+_resource_scope = contextvars.ContextVar('nexus_resource_scope', default=None)
+
+
+# NexusRequest.execute calls within the block share a NexusResourceScope, pass a scope to continue it in another block or thread.
+# Scopes are per thread and can be nested
+@contextlib.contextmanager
+def nexus_resource_scope(scope: Optional[NexusResourceScope] = None):
+    scope = scope or NexusResourceScope()
+    token = _resource_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _resource_scope.reset(token)
+
+
 class NexusRequest:
     def __init__(self, method: str, link_href: str = None, link_full: list = None,
                  input_response: Optional[dict] = None, payload: Optional[dict] = None,
@@ -234,6 +303,39 @@ class NexusRequest:
         return f"NexusRequest(href={self.link_href}, method={self.method}, json_body={self.payload})"
 
     def execute(self, input_response):
+        final_url = self.resolve_url(input_response)
+        scope = _resource_scope.get()
+
+        if self.method == 'GET':
+            response = scope.get(final_url) if scope else None
+            if response is None:
+                response = nexus_client.get_request(final_url)
+                if scope:
+                    scope.set(final_url, response)
+            return response
+
+        if self.method == 'POST':
+            response = nexus_client.post_request(final_url, json=self.payload)
+        elif self.method == 'PUT':
+            response = nexus_client.put_request(final_url, json=self.payload)
+        elif self.method == 'DELETE':
+            response = nexus_client.delete_request(final_url)
+        else:
+            raise ValueError(f"Unsupported method: {self.method}")
+
+        if scope:
+            scope.invalidate(final_url, self._source_href(input_response))
+        return response
+
+    # Self href of the resource the request's link was taken from
+    def _source_href(self, input_response):
+        source = self.input_response if self.input_response and '_links' in self.input_response else input_response
+        if isinstance(source, dict):
+            return source.get('_links', {}).get('self', {}).get('href')
+        return None
+
+    # Returns the URL of the request from the constructor's or the formal parameter input response
+    def resolve_url(self, input_response):
         final_url = None
 
         # Parse the key from the constructor's input response using link_href
@@ -264,18 +366,7 @@ class NexusRequest:
         if self.params:
             final_url += '?' + '&'.join([f"{key}={value}" for key, value in self.params.items()])
 
-        if self.method == 'GET':
-            response = nexus_client.get_request(final_url)
-        elif self.method == 'POST':
-            response = nexus_client.post_request(final_url, json=self.payload)
-        elif self.method == 'PUT':
-            response = nexus_client.put_request(final_url, json=self.payload)
-        elif self.method == 'DELETE':
-            response = nexus_client.delete_request(final_url)
-        else:
-            raise ValueError(f"Unsupported method: {self.method}")
-
-        return response
+        return final_url
 
     def _get_nested_value(self, data, keys):
         # Recursively get nested value from a dictionary using a list of keys.
@@ -0,0 +1,107 @@
+import time
+import logging
+
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from nexus.nexus_client import NexusRequest
+from utils.config import NEXUS_FLOW_MAX_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+# A named NexusRequest in a flow, the response of the first dependency is passed to the request as input response
+class NexusFlowNode:
+    def __init__(self, name: str, request: NexusRequest, depends_on: Optional[List[str]] = None):
+        self.name = name
+        self.request = request
+        self.depends_on = depends_on or []
+
+    def __repr__(self):
+        return f"NexusFlowNode(name={self.name}, request={self.request}, depends_on={self.depends_on})"
+
+
+class NexusFlowError(Exception):
+    def __init__(self, node_name, error, flow_result):
+        super().__init__(f"Nexus flow node '{node_name}' failed: {error}")
+        self.node_name = node_name
+        self.error = error
+        self.flow_result = flow_result
+
+
+# Responses and timings (seconds) of the executed nodes by name
+class NexusFlowResult:
+    def __init__(self):
+        self.results: Dict[str, object] = {}
+        self.timings: Dict[str, float] = {}
+
+    def __getitem__(self, name):
+        return self.results[name]
+
+    def __contains__(self, name):
+        return name in self.results
+
+
+def _validate_nexus_flow(nodes: List[NexusFlowNode]):
+    names = [node.name for node in nodes]
+    if len(names) != len(set(names)):
+        raise ValueError(f"Duplicate node names in Nexus flow: {names}")
+
+    nodes_by_name = {node.name: node for node in nodes}
+    for node in nodes:
+        unknown = [name for name in node.depends_on if name not in nodes_by_name]
+        if unknown:
+            raise ValueError(f"Node '{node.name}' depends on unknown nodes: {unknown}")
+
+    # Kahn's algorithm, nodes left with dependencies are part of a cycle
+    remaining = {node.name: set(node.depends_on) for node in nodes}
+    ready = [name for name, depends_on in remaining.items() if not depends_on]
+    while ready:
+        name = ready.pop()
+        del remaining[name]
+        for other, depends_on in remaining.items():
+            if name in depends_on:
+                depends_on.discard(name)
+                if not depends_on:
+                    ready.append(other)
+    if remaining:
+        raise ValueError(f"Nexus flow has a dependency cycle between: {sorted(remaining)}")
+
+
+def _execute_node(node: NexusFlowNode, input_response):
+    start = time.time()
+    response = node.request.execute(input_response)
+    # The Nexus client returns None for failed requests
+    if response is None:
+        raise ValueError(f"No response for {node.request}")
+    node.request.process_response(response, node.request)
+    return response, time.time() - start
+
+
+# Executes a DAG of NexusFlowNodes, independent nodes run concurrently on at most max_workers threads.
+# The first failing node, or node without a response, stops the flow and is raised as a NexusFlowError, nodes already running are finished first.
+def execute_nexus_dag(nodes: List[NexusFlowNode], max_workers: int = NEXUS_FLOW_MAX_WORKERS) -> NexusFlowResult:
+    _validate_nexus_flow(nodes)
+    flow_result = NexusFlowResult()
+    pending = list(nodes)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for node in [node for node in pending if all(name in flow_result for name in node.depends_on)]:
+                input_response = flow_result[node.depends_on[0]] if node.depends_on else None
+                running[executor.submit(_execute_node, node, input_response)] = node
+                pending.remove(node)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    response, duration = future.result()
+                except Exception as e:
+                    wait(running)
+                    logger.error(f"Nexus flow node '{node.name}' failed: {e}")
+                    raise NexusFlowError(node.name, e, flow_result) from e
+                flow_result.results[node.name] = response
+                flow_result.timings[node.name] = duration
+    return flow_result
@@ -0,0 +1,244 @@
+import os
+import fcntl
+import random
+import logging
+import pkgutil
+import importlib
+import threading
+
+from datetime import datetime, timedelta
+
+from job_runner import job_runner, SKIP_IF_RUNNING, SKIPPED
+from utils.config import POD_NAME, SCHEDULER_LOCK_DIR
+
+logger = logging.getLogger(__name__)
+
+# Replicas that are not leader of a job try to take over at least this often
+LEADER_RETRY_SECONDS = 60
+
+
+# Standard 5 field cron expression "minute hour day-of-month month day-of-week", fields accept *, */n, a-b, a-b/n and lists.
+# Day of week is 0-6 from Sunday (7 is also Sunday), a day matches either day field if both are restricted, as in cron
+class CronTrigger:
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression must have 5 fields: {expression}')
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, days_of_week = [self._parse_field(field, low, high) for field, (low, high) in zip(fields, self.FIELDS)]
+        self.days_of_week = {day % 7 for day in days_of_week}
+        self.any_day = fields[2] == '*'
+        self.any_day_of_week = fields[4] == '*'
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = (int(value) for value in value_range.split('-'))
+            else:
+                start = end = int(value_range)
+                if step:
+                    end = high
+            if start < low or end > high or start > end:
+                raise ValueError(f'Cron field out of range {low}-{high}: {field}')
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, time):
+        day = time.day in self.days
+        day_of_week = (time.isoweekday() % 7) in self.days_of_week
+        if self.any_day or self.any_day_of_week:
+            return day and day_of_week
+        return day or day_of_week
+
+    # First matching minute after now, previous is not used since cron times are absolute
+    def next_after(self, previous, now):
+        time = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        end = time + timedelta(days=5 * 366)
+        while time < end:
+            if time.month not in self.months:
+                time = (time.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self.hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError(f'Cron expression never matches: {self.expression}')
+
+    def __repr__(self):
+        return f'cron({self.expression})'
+
+
+# Fixed interval aligned to the previous run time, so run times do not drift with scheduling delays
+class IntervalTrigger:
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError(f'Interval must be positive: {seconds}')
+        self.interval = timedelta(seconds=seconds)
+
+    def next_after(self, previous, now):
+        if previous is None or previous > now:
+            return now + self.interval
+        return previous + ((now - previous) // self.interval + 1) * self.interval
+
+    def __repr__(self):
+        return f'interval({self.interval})'
+
+
+class ScheduledJob:
+    def __init__(self, name, job, trigger, jitter=0, misfire_grace=60, kwargs=None):
+        self.name = name
+        self.job = job
+        self.trigger = trigger
+        self.jitter = jitter
+        self.misfire_grace = misfire_grace
+        self.kwargs = kwargs or {}
+        self.scheduled = None
+        self.next_run = None
+        self.lock_file = None
+
+    # Missed run times are coalesced, the next run is the first run time after now
+    def schedule_next(self, now):
+        self.scheduled = self.trigger.next_after(self.scheduled, now)
+        self.next_run = self.scheduled + timedelta(seconds=random.uniform(0, self.jitter))
+
+    def __repr__(self):
+        return f'ScheduledJob(name={self.name}, trigger={self.trigger}, next_run={self.next_run})'
+
+
+# Builds a ScheduledJob from the SCHEDULE of a job module, e.g. {"cron": "*/30 * * * *"} or {"interval": 1800}
+# with the optional keys "jitter" (seconds added at random to each run), "misfire_grace" (seconds a run may start late) and "kwargs"
+def scheduled_job_from_module(name, module):
+    schedule = getattr(module, 'SCHEDULE', None)
+    if not schedule:
+        return None
+    if 'cron' in schedule:
+        trigger = CronTrigger(schedule['cron'])
+    elif 'interval' in schedule:
+        trigger = IntervalTrigger(schedule['interval'])
+    else:
+        raise ValueError(f'Schedule of {name} needs "cron" or "interval": {schedule}')
+    return ScheduledJob(name, getattr(module, 'job'), trigger, jitter=schedule.get('jitter', 0), misfire_grace=schedule.get('misfire_grace', 60),
+                        kwargs=schedule.get('kwargs'))
+
+
+# Scheduled jobs of the modules in jobs, named like the job endpoints. E.g. nexus_flow_brugerauth.py -> nexus-flow-brugerauth
+def discover_scheduled_jobs():
+    import jobs
+
+    scheduled_jobs = []
+    for module_info in pkgutil.iter_modules(jobs.__path__):
+        try:
+            module = importlib.import_module(f'jobs.{module_info.name}')
+            scheduled_job = scheduled_job_from_module(module_info.name.replace('_', '-'), module)
+        except Exception as e:
+            logger.error(f'Error loading schedule of job {module_info.name}: {e}')
+            continue
+        if scheduled_job:
+            scheduled_jobs.append(scheduled_job)
+    return scheduled_jobs
+
+
+# Runs scheduled jobs through the job runner in a background thread.
+# Runs never overlap with a run of the same job, runs that are more than misfire_grace seconds late are skipped,
+# and only the replica holding a job's file lock in the shared lock dir runs it, other replicas take over when the lock is released.
+class Scheduler:
+    def __init__(self, scheduled_jobs=None, lock_dir=SCHEDULER_LOCK_DIR, runner=job_runner):
+        self.scheduled_jobs = scheduled_jobs
+        self.lock_dir = lock_dir
+        self.runner = runner
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Raises ValueError without a lock dir, since every replica would then run every job
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        if not self.lock_dir:
+            raise ValueError('SCHEDULER_LOCK_DIR must be set to a directory shared by all replicas to enable the scheduler')
+        if self.scheduled_jobs is None:
+            self.scheduled_jobs = discover_scheduled_jobs()
+        now = datetime.now()
+        for scheduled_job in self.scheduled_jobs:
+            scheduled_job.schedule_next(now)
+            logger.info(f'Scheduled {scheduled_job}')
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        for scheduled_job in self.scheduled_jobs or []:
+            self._release(scheduled_job)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.run_pending(datetime.now())
+            next_run = min((scheduled_job.next_run for scheduled_job in self.scheduled_jobs), default=None)
+            timeout = LEADER_RETRY_SECONDS if next_run is None else (next_run - datetime.now()).total_seconds()
+            self._stop.wait(min(max(timeout, 0), LEADER_RETRY_SECONDS))
+
+    # Starts the jobs that are due, returns the job records of the started runs
+    def run_pending(self, now):
+        records = []
+        for scheduled_job in self.scheduled_jobs:
+            if scheduled_job.next_run > now:
+                continue
+            late = (now - scheduled_job.next_run).total_seconds()
+            if late > scheduled_job.misfire_grace:
+                logger.warning(f'Skipping misfired run of {scheduled_job.name}, {late:.0f} seconds late')
+            elif self._is_leader(scheduled_job):
+                record = self.runner.submit(scheduled_job.name, scheduled_job.job, scheduled_job.kwargs, policy=SKIP_IF_RUNNING,
+                                            accepts_progress=False)
+                if record.status != SKIPPED:
+                    logger.info(f'Started scheduled job {scheduled_job.name} ({record.id})')
+                records.append(record)
+            scheduled_job.schedule_next(now)
+        return records
+
+    def _lock_path(self, scheduled_job):
+        return os.path.join(self.lock_dir, f'{scheduled_job.name}.lock')
+
+    # Leader election with an exclusive file lock per job that is held until the process exits
+    def _is_leader(self, scheduled_job):
+        if not self.lock_dir:
+            return False
+        if scheduled_job.lock_file:
+            return True
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            lock_file = open(self._lock_path(scheduled_job), 'a+')
+        except OSError as e:
+            logger.error(f'Error opening scheduler lock for {scheduled_job.name}: {e}')
+            return False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        lock_file.truncate(0)
+        lock_file.write(f'{POD_NAME} {os.getpid()}\n')
+        lock_file.flush()
+        scheduled_job.lock_file = lock_file
+        logger.info(f'Became scheduler leader for {scheduled_job.name}')
+        return True
+
+    def _release(self, scheduled_job):
+        if scheduled_job.lock_file:
+            fcntl.flock(scheduled_job.lock_file, fcntl.LOCK_UN)
+            scheduled_job.lock_file.close()
+            scheduled_job.lock_file = None
+
+
+scheduler = Scheduler()
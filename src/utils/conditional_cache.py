@@ -0,0 +1,64 @@
+import time
+import logging
+import itertools
+
+from utils.keyed_lock import KeyedLock
+
+logger = logging.getLogger(__name__)
+
+_versions = itertools.count(1)
+
+
+class CachedResource:
+    def __init__(self, value, index, etag, last_modified):
+        self.value = value
+        self.index = index
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.monotonic()
+        # Unique per download, so data derived from the value can be reused while the version is unchanged
+        self.version = next(_versions)
+
+
+# Cache of GET responses by href with a TTL. Expired entries are revalidated with If-None-Match / If-Modified-Since when the
+# server sent an ETag or Last-Modified, a 304 keeps the cached value and its index. build(value) precomputes the index of a value
+# when it is downloaded. If a refresh fails the stale entry is returned. Concurrent refreshes of the same href are single-flight
+class ConditionalResourceCache:
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self._locks = KeyedLock()
+
+    def get(self, api_client, href, build=None) -> CachedResource:
+        with self._locks(href):
+            entry = self.entries.get(href)
+            if entry and time.monotonic() - entry.fetched < self.ttl_seconds:
+                return entry
+
+            headers = {}
+            if entry and entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry and entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+            value = api_client.get(href, headers=headers)
+            if entry and api_client.last_status_code == 304:
+                logger.info(f'{href} not modified')
+                entry.fetched = time.monotonic()
+                return entry
+            if value is None:
+                if entry:
+                    logger.warning(f'Failed to refresh {href} - using cached value')
+                return entry
+
+            response_headers = api_client.last_response_headers or {}
+            entry = CachedResource(value, build(value) if build else None, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+            self.entries[href] = entry
+            return entry
+
+    # Removes one href, or all hrefs if no href is given
+    def invalidate(self, href=None):
+        if href is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(href, None)
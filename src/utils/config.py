@@ -10,16 +10,50 @@ DEBUG = os.getenv('DEBUG', 'False') in ['True', 'true']
 PORT = os.getenv('PORT', '8080')
 POD_NAME = os.getenv('POD_NAME', 'Pod name not set')
 
+# Jobs - number of finished job runs kept in memory for GET /jobs/<job_id>
+JOB_HISTORY_SIZE = int(os.getenv('JOB_HISTORY_SIZE', '100'))
+
+# Scheduler - runs the jobs with a SCHEDULE, only the replica holding a job's lock file in SCHEDULER_LOCK_DIR runs it.
+# SCHEDULER_LOCK_DIR is required when the scheduler is enabled and must be a mount shared by all pods
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'False') in ['True', 'true']
+SCHEDULER_LOCK_DIR = os.getenv('SCHEDULER_LOCK_DIR', '').strip()
+
+# HTTP connection pools - HTTP_POOL_HOST_MAXSIZE sets pool size per host, e.g. "nexus.example.dk=20,kp.example.dk=5"
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+HTTP_POOL_HOST_MAXSIZE = {host.strip(): int(size) for host, size in (item.split('=') for item in os.getenv('HTTP_POOL_HOST_MAXSIZE', '').split(',') if '=' in item)}
+
 DELTA_TOP_ADM_UNIT_UUID = os.environ['DELTA_TOP_ADM_UNIT_UUID'].strip()
 DELTA_CERT_BASE64 = os.environ['DELTA_CERT_BASE64'].strip()
 DELTA_CERT_PASS = os.environ['DELTA_CERT_PASS'].strip()
 DELTA_BASE_URL = os.environ['DELTA_BASE_URL'].strip()
+DELTA_POOL_MAXSIZE = int(os.getenv('DELTA_POOL_MAXSIZE', '10'))
+DELTA_MAX_WORKERS = int(os.getenv('DELTA_MAX_WORKERS', '8'))
+DELTA_REQUEST_TIMEOUT = float(os.getenv('DELTA_REQUEST_TIMEOUT', '60'))
+DELTA_GRAPH_QUERY_BATCH_SIZE = int(os.getenv('DELTA_GRAPH_QUERY_BATCH_SIZE', '25'))
+DELTA_QUERY_BATCH_SIZE = int(os.getenv('DELTA_QUERY_BATCH_SIZE', '50'))
+# Directory for persisted Delta state (change cursor and adm. org. snapshot), must be on a writable mount. Not set disables persisting
+DELTA_STATE_DIR = os.getenv('DELTA_STATE_DIR', '').strip()
+DELTA_CURSOR_OVERLAP_SECONDS = int(os.getenv('DELTA_CURSOR_OVERLAP_SECONDS', '120'))
+# Number of later runs a change of a failed employee is retried in before it is given up
+DELTA_CHANGE_MAX_RETRIES = int(os.getenv('DELTA_CHANGE_MAX_RETRIES', '3'))
+# Adm. org. list is refreshed in the background after TTL, and in the foreground after MAX_STALE (0 = never)
+DELTA_ADM_ORG_TTL_SECONDS = int(os.getenv('DELTA_ADM_ORG_TTL_SECONDS', '3600'))
+DELTA_ADM_ORG_MAX_STALE_SECONDS = int(os.getenv('DELTA_ADM_ORG_MAX_STALE_SECONDS', '0'))
 
 # NEXUS
 NEXUS_URL = os.environ["NEXUS_URL"].strip()
 NEXUS_CLIENT_ID = os.environ["NEXUS_CLIENT_ID"].strip()
 NEXUS_CLIENT_SECRET = os.environ["NEXUS_CLIENT_SECRET"].strip()
 NEXUS_TOKEN_ROUTE = os.environ["NEXUS_TOKEN_ROUTE"].strip()
+NEXUS_HOME_TTL_SECONDS = int(os.getenv('NEXUS_HOME_TTL_SECONDS', '3600'))
+# Active organisations tree and suppliers are revalidated with the server after this TTL
+NEXUS_RESOURCE_CACHE_TTL_SECONDS = int(os.getenv('NEXUS_RESOURCE_CACHE_TTL_SECONDS', '900'))
+NEXUS_FLOW_MAX_WORKERS = int(os.getenv('NEXUS_FLOW_MAX_WORKERS', '4'))
+LUKNING_MAX_WORKERS = int(os.getenv('LUKNING_MAX_WORKERS', '8'))
+LUKNING_PARALLEL_PHASES = os.getenv('LUKNING_PARALLEL_PHASES', 'True') in ['True', 'true']
+LUKNING_BATCH_MAX_WORKERS = int(os.getenv('LUKNING_BATCH_MAX_WORKERS', '4'))
+BRUGERAUTH_MAX_WORKERS = int(os.getenv('BRUGERAUTH_MAX_WORKERS', '4'))
 
 # KP
 KP_URL = os.environ["KP_URL"].strip()
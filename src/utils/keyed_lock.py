@@ -0,0 +1,30 @@
+import threading
+import contextlib
+
+
+# One lock per key, e.g. to serialise updates of the same resource across worker threads. Locks are dropped when no thread holds or waits for them
+class KeyedLock:
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        with self._lock:
+            lock, users = self._locks.get(key, (None, 0))
+            lock = lock or threading.Lock()
+            self._locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._locks[key]
+                if users == 1:
+                    del self._locks[key]
+                else:
+                    self._locks[key] = (lock, users - 1)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
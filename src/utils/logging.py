@@ -3,12 +3,16 @@ import sys
 import logging
 
 from werkzeug import serving
-from prometheus_client import Gauge
+from prometheus_client import Gauge, Counter
 
 from .config import DEBUG
 
 # Prometheus
 APP_RUNNING = Gauge('up', '1 - app is running, 0 - app is down', labelnames=['name'])
+HTTP_POOL_REQUESTS = Counter('http_pool_requests', 'Requests sent through the pooled HTTP sessions', labelnames=['client', 'host'])
+HTTP_POOL_CONNECTIONS = Gauge('http_pool_connections', 'Connections opened by the pooled HTTP sessions', labelnames=['client', 'host'])
+REFRESH_DURATION = Gauge('refresh_duration_seconds', 'Duration of the last refresh of cached data', labelnames=['name'])
+REFRESH_DATA_AGE = Gauge('refresh_data_age_seconds', 'Age of cached data', labelnames=['name'])
 
 
 # Logging configuration
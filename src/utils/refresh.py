@@ -0,0 +1,81 @@
+import math
+import time
+import logging
+import threading
+
+from datetime import datetime
+
+from .logging import REFRESH_DURATION, REFRESH_DATA_AGE
+
+logger = logging.getLogger(__name__)
+
+
+# Coordinates refreshes of cached data so at most one refresh runs at a time.
+# Data older than ttl is served while it is refreshed in the background (stale-while-revalidate),
+# data older than max_stale (0 = no limit) or missing data is refreshed in the foreground.
+class RefreshCoordinator:
+    def __init__(self, name, refresh_func, last_updated_func, ttl_seconds=60 * 60, max_stale_seconds=0):
+        self.name = name
+        self.refresh_func = refresh_func
+        self.last_updated_func = last_updated_func
+        self.ttl_seconds = ttl_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self.in_flight = False
+        self.last_result = None
+        self.last_duration = None
+        self._condition = threading.Condition()
+        REFRESH_DATA_AGE.labels(name).set_function(self._age_metric)
+
+    # Seconds since the data was last updated, None if it never was
+    def age(self):
+        last_updated = self.last_updated_func()
+        if last_updated is None:
+            return None
+        return (datetime.now() - last_updated).total_seconds()
+
+    def _age_metric(self):
+        age = self.age()
+        return math.nan if age is None else age
+
+    def is_expired(self):
+        age = self.age()
+        return age is None or age > self.ttl_seconds
+
+    def is_too_stale(self):
+        age = self.age()
+        return age is None or (self.max_stale_seconds > 0 and age > self.max_stale_seconds)
+
+    # Runs a refresh in the calling thread, if a refresh is already running it waits for that one instead
+    def refresh(self):
+        with self._condition:
+            if self.in_flight:
+                logger.info(f'Waiting for running {self.name} refresh')
+                self._condition.wait_for(lambda: not self.in_flight)
+                return self.last_result
+            self.in_flight = True
+        return self._run()
+
+    # Starts a refresh in a background thread unless a refresh is already running
+    def refresh_in_background(self):
+        with self._condition:
+            if self.in_flight:
+                return False
+            self.in_flight = True
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    def _run(self):
+        start = time.time()
+        result = False
+        try:
+            result = bool(self.refresh_func())
+        except Exception as e:
+            logger.error(f'Error refreshing {self.name}: {e}')
+        finally:
+            self.last_duration = time.time() - start
+            REFRESH_DURATION.labels(self.name).set(self.last_duration)
+            with self._condition:
+                self.in_flight = False
+                self.last_result = result
+                self._condition.notify_all()
+        return result
@@ -0,0 +1,89 @@
+import weakref
+import threading
+import requests
+
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+from .logging import HTTP_POOL_REQUESTS, HTTP_POOL_CONNECTIONS
+
+
+# Thread-local requests sessions sharing one set of pooled keep-alive adapters.
+# The urllib3 connection pools behind the adapters are thread-safe, the session objects (cookies, hooks) are not,
+# so every thread gets its own session while all threads reuse the same TCP/TLS connections.
+class SessionPool:
+    def __init__(self, name, pool_connections=10, pool_maxsize=10, host_pool_maxsize=None, adapter_factory=HTTPAdapter, **adapter_kwargs):
+        self.name = name
+        self.pool_maxsize = pool_maxsize
+        self.host_pool_maxsize = host_pool_maxsize or {}
+        self._local = threading.local()
+        # Sessions of live threads only, a session is dropped with its thread so short-lived worker pools do not accumulate sessions
+        self._sessions = weakref.WeakSet()
+        self._sessions_lock = threading.Lock()
+
+        self.default_adapter = adapter_factory(pool_connections=pool_connections, pool_maxsize=pool_maxsize, **adapter_kwargs)
+
+        # Hosts with their own pool size get their own adapter mounted on both schemes
+        self.host_adapters = {}
+        for host, maxsize in (host_pool_maxsize or {}).items():
+            adapter = adapter_factory(pool_connections=1, pool_maxsize=maxsize, **adapter_kwargs)
+            for scheme in ('https://', 'http://'):
+                self.host_adapters[f'{scheme}{host}'] = adapter
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.default_adapter)
+            session.mount('http://', self.default_adapter)
+            for prefix, adapter in self.host_adapters.items():
+                session.mount(prefix, adapter)
+            session.hooks['response'].append(self._record_response)
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.add(session)
+        return session
+
+    # Number of connections kept to the host of the url
+    def maxsize_for(self, url):
+        return self.host_pool_maxsize.get(urlsplit(url).hostname, self.pool_maxsize)
+
+    def _adapters(self):
+        return {id(adapter): adapter for adapter in [self.default_adapter, *self.host_adapters.values()]}.values()
+
+    # Returns a dict with the host as key and the number of connections opened and requests sent as value
+    def stats(self):
+        stats = {}
+        for adapter in self._adapters():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host_stats = stats.setdefault(pool.host, {'connections': 0, 'requests': 0})
+                host_stats['connections'] += pool.num_connections
+                host_stats['requests'] += pool.num_requests
+        for host_stats in stats.values():
+            host_stats['reused'] = max(host_stats['requests'] - host_stats['connections'], 0)
+        return stats
+
+    def _record_response(self, response, *args, **kwargs):
+        host = urlsplit(response.url).hostname or ''
+        HTTP_POOL_REQUESTS.labels(self.name, host).inc()
+        # The adapter that sent the response, its pool for the host already exists
+        adapter = getattr(response, 'connection', None)
+        poolmanager = getattr(adapter, 'poolmanager', None)
+        if poolmanager is not None:
+            pool = poolmanager.connection_from_url(response.url)
+            HTTP_POOL_CONNECTIONS.labels(self.name, host).set(pool.num_connections)
+        return response
+
+    def close(self):
+        with self._sessions_lock:
+            for session in list(self._sessions):
+                session.close()
+            self._sessions = weakref.WeakSet()
+        for adapter in self._adapters():
+            adapter.close()
+        self._local = threading.local()
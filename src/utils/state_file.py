@@ -0,0 +1,39 @@
+import os
+import json
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+# Returns the content of a JSON state file, or None if it does not exist or cannot be read
+def read_state_file(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logger.error(f'Error reading state file {path}: {e}')
+        return None
+
+
+# Writes a JSON state file atomically, so a crash never leaves a half written file
+def write_state_file(path, data):
+    if not path:
+        return False
+    try:
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(data, file)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return True
+    except OSError as e:
+        logger.error(f'Error writing state file {path}: {e}')
+        return False
@@ -0,0 +1,53 @@
+import json
+import time
+import queue
+import logging
+import threading
+
+from datetime import timedelta
+from flask import Response
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+# Returns True if the request asks for a streamed response, with ?stream=true or an NDJSON Accept header
+def wants_stream(request, payload=None):
+    return (payload or {}).get('stream') is True or request.args.get('stream') in ['True', 'true'] or NDJSON_MIMETYPE in request.headers.get('Accept', '')
+
+
+# Streams the records emitted by run as NDJSON while it runs in a background thread, followed by a summary record.
+# run is called with an emit function and returns the result, a dict result is merged into the summary
+def stream_ndjson(run):
+    records = queue.Queue()
+    done = object()
+
+    def emit(record):
+        records.put(record)
+
+    def worker():
+        start = time.time()
+        summary = {'type': 'summary'}
+        try:
+            result = run(emit)
+            if isinstance(result, dict):
+                summary.update({key: value for key, value in result.items() if key != 'results'})
+            summary['success'] = bool(result.get('success') if isinstance(result, dict) else result)
+        except Exception as e:
+            logger.error(f'Error in streamed run: {e}')
+            summary.update({'success': False, 'message': str(e)})
+        summary['time'] = str(timedelta(seconds=time.time() - start))
+        records.put(summary)
+        records.put(done)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    def generate():
+        while True:
+            record = records.get()
+            if record is done:
+                return
+            yield json.dumps(record, default=str) + '\n'
+
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import pytest
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from requests.adapters import HTTPAdapter
+from delta import DeltaClient, AdmOrgIndex, PayloadTemplate
+
+delta_url = "https://delta-mock.com"
+top_adm_org_uuid = "top-uuid"
+
+
+class FakePkcs12Adapter(HTTPAdapter):
+    instances = 0
+
+    def __init__(self, *args, pkcs12_data=None, pkcs12_password=None, **kwargs):
+        FakePkcs12Adapter.instances += 1
+        super().__init__(*args, **kwargs)
+
+
+@pytest.fixture
+def delta_client():
+    FakePkcs12Adapter.instances = 0
+    with patch('delta.Pkcs12Adapter', FakePkcs12Adapter):
+        yield DeltaClient(cert_base64="dGVzdA==", cert_pass="test", base_url=delta_url, top_adm_org_uuid=top_adm_org_uuid)
+
+
+def test_post_requests_share_one_pkcs12_session(delta_client, requests_mock):
+    requests_mock.post(delta_url + "/query", json={"queryResults": []})
+
+    for _ in range(3):
+        response = delta_client._make_post_request('{"queries": []}', '/query')
+        assert response.json() == {"queryResults": []}
+
+    assert FakePkcs12Adapter.instances == 1
+    assert requests_mock.call_count == 3
+
+
+def _graph_query_result(uuid, sub_uuids):
+    if sub_uuids is None:
+        return {"instances": []}
+    return {"instances": [{"identity": {"uuid": uuid}, "childrenObjects": [{"identity": {"uuid": sub}} for sub in sub_uuids]}]}
+
+
+def _mock_employee_probes(requests_mock, units, status_codes=None):
+    def callback(request, context):
+        uuids = [query["parameterMap"]["admUuid"] for query in request.json()["graphQueries"]]
+        context.status_code = max((status_codes or {}).get(uuid, 200) for uuid in uuids)
+        return {"graphQueryResult": [_graph_query_result(uuid, units[uuid]) for uuid in uuids]}
+
+    requests_mock.post(delta_url + "/graph-query", json=callback)
+
+
+def test_check_has_employees_is_deterministic(delta_client, requests_mock):
+    units = {"a": ["b", "c"], "b": None, "c": None, "d": ["e"], "e": ["f"], "f": None}
+    _mock_employee_probes(requests_mock, units)
+    payload = delta_client._get_payload('adm_ord_with_employees_two_layers_down')
+
+    result = delta_client._check_has_employees_and_add_sub_adm_org_units(list(units), payload)
+
+    # "d" is removed because its sub unit "e" has employees of its own
+    assert result == {"a": ["b", "c"], "e": ["f"]}
+    assert list(result) == ["a", "e"]
+
+
+def test_check_has_employees_reports_failures(delta_client, requests_mock):
+    units = {"a": ["b"], "b": None, "c": None}
+    _mock_employee_probes(requests_mock, units, status_codes={"c": 500})
+    payload = delta_client._get_payload('adm_ord_with_employees_two_layers_down')
+
+    result = delta_client._check_has_employees_and_add_sub_adm_org_units(list(units), payload)
+
+    assert result is None
+    assert "c" in delta_client.adm_org_probe_failures
+
+
+def test_employee_probes_are_batched(delta_client, requests_mock):
+    units = {str(i): None for i in range(7)}
+    units["0"] = ["1"]
+    _mock_employee_probes(requests_mock, units)
+    payload = delta_client._get_payload('adm_ord_with_employees_two_layers_down')
+    delta_client.graph_query_batch_size = 3
+
+    result = delta_client._check_has_employees_and_add_sub_adm_org_units(list(units), payload)
+
+    assert result == {"0": ["1"]}
+    assert requests_mock.call_count == 3
+
+
+def _registration(employee, adm_unit, reg_date_time):
+    return {
+        "objectUuid": employee,
+        "regDateTime": reg_date_time,
+        "typeRefBiList": [{"value": {"userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit", "refObjIdentity": {"uuid": adm_unit}}}]
+    }
+
+
+def _engagement(adm_unit, dq_number, position="Sygeplejerske (RG_7002)"):
+    return {"instances": [{
+        "state": "STATE_ACTIVE",
+        "typeRefs": [
+            {"userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit", "refObjIdentity": {"uuid": adm_unit}},
+            {"userKey": "APOS-Types-Engagement-TypeRelation-Position", "refObjIdentity": {"userKey": position}}
+        ],
+        "inTypeRefs": [{"refObjTypeUserKey": "APOS-Types-User", "refObjIdentity": {"userKey": dq_number}}]
+    }]}
+
+
+def _mock_employee_changes(requests_mock, registrations, engagements, fail_batches=False):
+    requests_mock.post(delta_url + "/history", json={"queryResultList": [{"registrationList": registrations}]})
+
+    def callback(request, context):
+        uuids = [query["criteria"]["identity"]["objUuid"] for query in request.json()["queries"]]
+        if fail_batches and len(uuids) > 1:
+            context.status_code = 400
+            return {}
+        return {"queryResults": [engagements[uuid] for uuid in uuids]}
+
+    requests_mock.post(delta_url + "/query", json=callback)
+
+
+@pytest.mark.parametrize("fail_batches", [False, True])
+def test_get_employees_changed_batches_lookups(delta_client, requests_mock, fail_batches):
+    delta_client.adm_org_list = {"adm-1": ["sub-1"], "adm-2": []}
+    delta_client.last_adm_org_list_updated = datetime.now()
+    registrations = [
+        _registration("emp-1", "adm-1", "2024-01-01T10:00:00.000Z"),
+        _registration("emp-2", "adm-2", "2024-01-01T10:00:00.000Z"),
+        _registration("emp-3", "adm-1", "2024-01-01T10:00:00.000Z"),
+        _registration("emp-4", "not-relevant", "2024-01-01T10:00:00.000Z")
+    ]
+    engagements = {
+        "emp-1": _engagement("adm-1", "DQ1"),
+        "emp-2": _engagement("adm-2", "DQ2", position="Not imported"),
+        "emp-3": _engagement("adm-1", "DQ3")
+    }
+    _mock_employee_changes(requests_mock, registrations, engagements, fail_batches=fail_batches)
+
+    result = delta_client.get_employees_changed()
+
+    assert [{"user": employee["user"], "organizations": employee["organizations"]} for employee in result] == [
+        {"user": "DQ1", "organizations": ["adm-1", "sub-1"]},
+        {"user": "DQ3", "organizations": ["adm-1", "sub-1"]}
+    ]
+    assert result[0]["change"] == {"employee": "emp-1", "admunit": "adm-1", "time": "2024-01-01T10:00:00.000Z", "attempts": 0}
+    query_calls = [request for request in requests_mock.request_history if request.path == "/query"]
+    assert len(query_calls) == (4 if fail_batches else 1)
+
+
+def test_change_cursor_resumes_and_skips_handled_registrations(delta_client, requests_mock, tmp_path):
+    delta_client.change_cursor_path = str(tmp_path / "cursor.json")
+    delta_client.adm_org_list = {"adm-1": []}
+    delta_client.last_adm_org_list_updated = datetime.now()
+    reg_date_time = datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+    _mock_employee_changes(requests_mock, [_registration("emp-1", "adm-1", reg_date_time)], {"emp-1": _engagement("adm-1", "DQ1")})
+
+    assert [employee["user"] for employee in delta_client.get_employees_changed()] == ["DQ1"]
+    assert delta_client.commit_change_cursor()
+    to_time = delta_client._load_change_cursor()["to_time"]
+
+    # The same registration is returned again in the overlap window but has already been handled
+    assert delta_client.get_employees_changed() == []
+    history_from = requests_mock.request_history[-1].json()["queryList"][0]["from"]
+    assert history_from < to_time
+    assert datetime.strptime(to_time, "%Y-%m-%dT%H:%M:%S.%fZ") - datetime.strptime(history_from, "%Y-%m-%dT%H:%M:%S.%fZ") == delta_client.cursor_overlap
+
+
+def test_failing_employee_is_retried_while_change_cursor_moves_forward(delta_client, requests_mock, tmp_path):
+    delta_client.change_cursor_path = str(tmp_path / "cursor.json")
+    delta_client.change_max_retries = 1
+    delta_client.adm_org_list = {"adm-1": []}
+    delta_client.last_adm_org_list_updated = datetime.now()
+    reg_date_time = datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+    _mock_employee_changes(requests_mock, [_registration("emp-1", "adm-1", reg_date_time)], {"emp-1": _engagement("adm-1", "DQ1")})
+
+    to_times = []
+    for attempts in [0, 1]:
+        employees = delta_client.get_employees_changed()
+        assert [(employee["user"], employee["change"]["attempts"]) for employee in employees] == [("DQ1", attempts)]
+        time.sleep(0.01)
+        assert delta_client.commit_change_cursor(employees)
+        to_times.append(delta_client._load_change_cursor()["to_time"])
+
+    # Given up after change_max_retries, and the cursor moved forward on every run
+    assert delta_client._load_change_cursor()["retry"] == []
+    assert delta_client.get_employees_changed() == []
+    assert to_times[0] < to_times[1]
+
+
+def test_adm_org_snapshot_is_served_on_cold_start(requests_mock, tmp_path):
+    adm_org_list = {"adm-1": ["sub-1"]}
+    with patch('delta.Pkcs12Adapter', FakePkcs12Adapter):
+        client = DeltaClient(cert_base64="dGVzdA==", cert_pass="test", base_url=delta_url, top_adm_org_uuid=top_adm_org_uuid, state_dir=str(tmp_path))
+        client.adm_org_list = adm_org_list
+        client.last_adm_org_list_updated = datetime.now()
+        client._save_adm_org_snapshot()
+
+        restarted_client = DeltaClient(cert_base64="dGVzdA==", cert_pass="test", base_url=delta_url, top_adm_org_uuid=top_adm_org_uuid, state_dir=str(tmp_path))
+
+    with patch.object(DeltaClient, '_update_adm_org_list_background') as background_update:
+        assert restarted_client.get_adm_org_list() == adm_org_list
+        assert restarted_client.get_adm_org_list() == adm_org_list
+
+    background_update.assert_called_once()
+    assert not requests_mock.called
+
+
+def test_concurrent_adm_org_list_updates_are_single_flight(delta_client):
+    calls = []
+
+    def slow_get_adm_org_index():
+        calls.append(1)
+        time.sleep(0.2)
+        return AdmOrgIndex({"adm-1": []})
+
+    with patch.object(delta_client, '_get_adm_org_index', side_effect=slow_get_adm_org_index):
+        threads = [threading.Thread(target=delta_client.get_adm_org_list) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        delta_client.last_adm_org_list_updated = datetime.now() - timedelta(hours=2)
+        assert delta_client.get_adm_org_list() == {"adm-1": []}
+        delta_client._update_adm_org_list_background()
+        while delta_client.adm_org_refresh.in_flight:
+            time.sleep(0.01)
+
+    assert len(calls) == 2
+    assert delta_client.adm_org_refresh.age() < 60
+
+
+def test_adm_org_index_from_graph_instances():
+    instances = [{"identity": {"uuid": "top"}, "childrenObjects": [
+        {"identity": {"uuid": "a"}, "childrenObjects": [{"identity": {"uuid": "a1"}}, {"identity": {"uuid": "a2"}}]},
+        {"identity": {"uuid": "b"}, "childrenObjects": [{"identity": {"uuid": "b1"}}]}
+    ]}]
+
+    index = AdmOrgIndex.from_graph_instances(instances).with_grants(AdmOrgIndex.prune_units_with_employees({"a": ["a1", "a2"], "a1": [], "b": ["b1"]}))
+
+    assert index.tree_order == ["top", "a", "a1", "a2", "b", "b1"]
+    assert index.grants == {"a1": [], "b": ["b1"]}
+    assert index.all_organizations == ["a1", "b", "b1"]
+    assert index.granted_units("b") == ["b", "b1"]
+    assert index.granted_units("a") is None
+    assert index.ancestors("a2") == {"a", "top"}
+    assert index.descendants("top") == {"a", "a1", "a2", "b", "b1"}
+
+
+def test_payload_template_renders_and_reloads(tmp_path):
+    payload_path = tmp_path / "payload.json"
+    payload_path.write_text('{"queries": [{"criteria": {"identity": {"objUuid": "<uuid>"}}, "name": "unit <uuid>", "limit": 1}]}')
+    template = PayloadTemplate(str(payload_path))
+
+    assert template.endpoint == "/query"
+    assert json.loads(template.render_bytes({"uuid": "a"})) == {"queries": [{"criteria": {"identity": {"objUuid": "a"}}, "name": "unit a", "limit": 1}]}
+    assert json.loads(template.render_batch_bytes([{"uuid": "a"}, {"uuid": "b"}]))["queries"][1]["criteria"]["identity"]["objUuid"] == "b"
+    assert template.structure["queries"][0]["criteria"]["identity"]["objUuid"] == "<uuid>"
+    with pytest.raises(KeyError):
+        template.render({})
+
+    payload_path.write_text('{"graphQueries": [{"parameterMap": {"admUuid": "<uuid>"}}]}')
+    os.utime(payload_path, (template.mtime + 10, template.mtime + 10))
+
+    assert json.loads(template.reload_if_changed().render_bytes({"uuid": "c"})) == {"graphQueries": [{"parameterMap": {"admUuid": "c"}}]}
+    assert template.endpoint == "/graph-query"
@@ -0,0 +1,82 @@
+import json
+import time
+import pytest
+import threading
+from unittest.mock import patch
+from main import create_app
+from job_runner import JobRunner, job_runner
+
+
+@pytest.fixture()
+def client():
+    app = create_app()
+    app.config.update({
+        "TESTING": True,
+    })
+    return app.test_client()
+
+
+def fake_job(count=2, on_progress=None):
+    for index in range(count):
+        on_progress({'type': 'employee', 'index': index + 1})
+    return True
+
+
+def test_start_job_streams_ndjson(client):
+    with patch('job_endpoints.get_job', return_value=fake_job):
+        response = client.post('/jobs/fake-job?stream=true', json={'start': True, 'count': 3})
+        records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert [record['index'] for record in records[:-1]] == [1, 2, 3]
+    assert records[-1]['type'] == 'summary' and records[-1]['success'] is True
+
+
+def test_start_job_stream_summary_includes_job_summary(client):
+    def summary_job(on_progress=None):
+        on_progress({'type': 'employee', 'index': 1})
+        return {'success': True, 'total': 1, 'succeeded': 1, 'failed': 0, 'results': [{'user': 'a'}]}
+
+    with patch('job_endpoints.get_job', return_value=summary_job):
+        response = client.post('/jobs/summary-job?stream=true', json={'start': True})
+        summary = json.loads(response.get_data(as_text=True).splitlines()[-1])
+
+    assert summary['total'] == 1 and summary['succeeded'] == 1 and summary['failed'] == 0
+    assert summary['job_id'] and summary['status'] == 'succeeded' and 'results' not in summary
+
+
+def test_start_job_returns_job_id_and_status(client):
+    with patch('job_endpoints.get_job', return_value=fake_job):
+        response = client.post('/jobs/fake-job', json={'start': True, 'count': 2})
+        job_id = response.get_json()['job_id']
+        job_runner.get(job_id).wait(5)
+        status = client.get(f'/jobs/{job_id}')
+
+    assert response.status_code == 202
+    assert status.status_code == 200
+    assert status.get_json()['status'] == 'succeeded'
+    assert status.get_json()['progress'] == 2
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def test_job_runner_concurrency_policies():
+    release = threading.Event()
+
+    def blocking_job():
+        release.wait(5)
+        return True
+
+    runner = JobRunner(max_history=3)
+    first = runner.submit('blocking', blocking_job)
+    skipped = runner.submit('blocking', blocking_job)
+    queued = runner.submit('blocking', blocking_job, policy='queue')
+    time.sleep(0.05)
+
+    assert skipped.status == 'skipped'
+    assert first.status == 'running' and queued.status == 'queued'
+    release.set()
+    assert queued.wait(5) and queued.success
+
+    runner.submit('other', lambda: True).wait(5)
+    assert len(runner.records) == 3 and runner.get(first.id) is None
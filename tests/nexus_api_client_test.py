@@ -1,7 +1,10 @@
+import gc
 import os
 import pytest
+import threading
 from unittest.mock import patch
-from nexus.nexus_client import NexusAPIClient
+from nexus.nexus_client import NexusAPIClient, NexusClient, NexusRequest, execute_nexus_flow, nexus_resource_scope
+from utils.conditional_cache import ConditionalResourceCache
 
 nexus_url = "https://nexus-mock.com"
 
@@ -101,3 +104,82 @@ def test_refresh_access_token_success(nexus_client, requests_mock):
     assert response == mock_response["access_token"]
     assert nexus_client.access_token == mock_response["access_token"]
     assert nexus_client.refresh_token == mock_response["refresh_token"]
+
+
+def test_session_is_thread_local_on_shared_pool(nexus_client):
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(nexus_client.session))
+    thread.start()
+    thread.join()
+
+    assert nexus_client.session is nexus_client.session
+    assert sessions[0] is not nexus_client.session
+    assert sessions[0].get_adapter(nexus_url) is nexus_client.session.get_adapter(nexus_url)
+
+
+def test_sessions_of_finished_threads_are_released(nexus_client):
+    for _ in range(5):
+        thread = threading.Thread(target=lambda: nexus_client.session)
+        thread.start()
+        thread.join()
+    gc.collect()
+
+    assert len(nexus_client.session_pool._sessions) <= 1
+
+
+def test_home_resource_is_cached_and_invalidated_on_404(requests_mock):
+    client = NexusClient(client_id="home_test_id", client_secret="test_secret", url=nexus_url)
+    home_url = nexus_url + "/api/core/mobile/randers/v2/"
+    requests_mock.get(home_url, [
+        {"json": {"_links": {"professionals": {"href": nexus_url + "/old-professionals"}}}},
+        {"json": {"_links": {"professionals": {"href": nexus_url + "/professionals"}}}}
+    ])
+    requests_mock.get(nexus_url + "/old-professionals", status_code=404)
+    requests_mock.get(nexus_url + "/professionals", json=[{"id": 1}])
+
+    with patch.object(NexusAPIClient, 'get_auth_headers', return_value={"Authorization": "Bearer test_token"}):
+        assert client.find_professional_by_query("DQ1") == [{"id": 1}]
+        assert client.find_professional_by_query("DQ2") == [{"id": 1}]
+
+    home_calls = [request for request in requests_mock.request_history if request.url == home_url]
+    assert len(home_calls) == 2
+    assert requests_mock.request_history[-1].qs == {"query": ["dq2"]}
+
+
+def test_resource_scope_memoizes_gets_until_update(requests_mock):
+    professional = {"_links": {"self": {"href": nexus_url + "/professionals/1"}}}
+    professional_self = {"id": 1, "_links": {"self": {"href": nexus_url + "/professionals/1"},
+                                             "updateOrganizations": {"href": nexus_url + "/professionals/1/organizations"}}}
+    requests_mock.get(nexus_url + "/professionals/1", json=professional_self)
+    requests_mock.post(nexus_url + "/professionals/1/organizations", json={"id": 1})
+
+    def self_request():
+        return NexusRequest(input_response=professional, link_href="self", method="GET")
+
+    with patch.object(NexusAPIClient, 'get_auth_headers', return_value={"Authorization": "Bearer test_token"}):
+        with nexus_resource_scope() as scope:
+            self_request().execute(None)["id"] = 2
+            assert self_request().execute(None) == professional_self
+            execute_nexus_flow([self_request(), NexusRequest(link_href="updateOrganizations", method="POST", payload={"added": [3]})])
+            self_request().execute(None)
+        self_request().execute(None)
+
+    gets = [request for request in requests_mock.request_history if request.method == "GET"]
+    assert scope.hits == 2
+    assert len(gets) == 3
+
+
+def test_conditional_resource_cache_revalidates_with_etag(requests_mock):
+    client = NexusAPIClient(client_id="cache_test_id", client_secret="test_secret", url=nexus_url)
+    cache = ConditionalResourceCache(ttl_seconds=0)
+    url = nexus_url + "/suppliers"
+    requests_mock.get(url, [{"json": [{"id": 1}], "headers": {"ETag": '"v1"'}}, {"status_code": 304}])
+    builds = []
+
+    with patch.object(NexusAPIClient, 'get_auth_headers', return_value={"Authorization": "Bearer test_token"}):
+        first = cache.get(client, url, build=lambda value: builds.append(value) or len(value))
+        second = cache.get(client, url, build=lambda value: builds.append(value) or len(value))
+
+    assert second is first and second.value == [{"id": 1}] and second.index == 1
+    assert len(builds) == 1
+    assert requests_mock.request_history[-1].headers["If-None-Match"] == '"v1"'
@@ -0,0 +1,157 @@
+import contextlib
+import time
+from unittest.mock import patch
+from jobs import nexus_flow_brugerauth
+from jobs.nexus_flow_brugerauth import ActiveOrganisationIndex, BrugerauthPlan
+from nexus.nexus_client import _resource_scope
+
+
+ACTIVE_ORGS = [
+    {'id': 1, 'sync_id': 'a', 'supplier': {'id': 10}},
+    {'id': 2, 'sync_id': 'b', 'supplier': None},
+    {'id': 3, 'sync_id': 'b', 'supplier': None},
+    {'id': 4, 'sync_id': 'c', 'supplier': None},
+]
+
+
+def test_active_organisation_index():
+    index = ActiveOrganisationIndex(ACTIVE_ORGS)
+
+    assert index.ids_for(['b', 'c', 'unknown']) == {2, 3, 4}
+    assert index.supplier_for('a') == {'id': 10}
+    assert index.supplier_for('unknown') is None
+
+
+def test_execute_brugerauth_updates_only_differences():
+    index = ActiveOrganisationIndex(ACTIVE_ORGS)
+    professional = {'id': 99}
+
+    with patch.object(nexus_flow_brugerauth, '_fetch_professional', return_value=professional), \
+         patch.object(nexus_flow_brugerauth, '_fetch_professional_org_syncIds', return_value=[{'id': 2, 'sync_id': 'b'}, {'id': 4, 'sync_id': 'c'}]), \
+         patch.object(nexus_flow_brugerauth, '_fetch_professional_configuration', return_value={'defaultOrganizationSupplier': None}), \
+         patch.object(nexus_flow_brugerauth, '_update_professional_organisations', return_value=True) as update_organisations, \
+         patch.object(nexus_flow_brugerauth, '_update_professional_supplier', return_value=True) as update_supplier:
+        nexus_flow_brugerauth.execute_brugerauth(index, 'user', ['a', 'b'], ['a', 'b', 'c'])
+
+    added, removed = update_organisations.call_args.args[1:]
+    assert added == [1, 3] and removed == [4]
+    update_supplier.assert_called_once_with(professional, {'id': 10}, 'user')
+
+
+def test_apply_brugerauth_sends_removals_without_additions():
+    plan = BrugerauthPlan('user')
+    plan.professional = {'id': 99}
+    plan.remove = [4]
+
+    with patch.object(nexus_flow_brugerauth, '_update_professional_organisations', return_value=True) as update_organisations:
+        assert nexus_flow_brugerauth.apply_brugerauth(plan)
+
+    update_organisations.assert_called_once_with({'id': 99}, [], [4])
+
+
+@contextlib.contextmanager
+def _patch_job(employees, plan, apply):
+    with patch.object(nexus_flow_brugerauth, '_get_active_organisation_index', return_value=ActiveOrganisationIndex(ACTIVE_ORGS)), \
+         patch.object(nexus_flow_brugerauth.delta_client, 'get_all_organizations', return_value=[]), \
+         patch.object(nexus_flow_brugerauth.delta_client, 'get_employees_changed', return_value=employees), \
+         patch.object(nexus_flow_brugerauth.delta_client, 'commit_change_cursor') as commit_change_cursor, \
+         patch.object(nexus_flow_brugerauth, 'plan_brugerauth', side_effect=plan), \
+         patch.object(nexus_flow_brugerauth, 'apply_brugerauth', side_effect=apply) as apply_brugerauth:
+        yield commit_change_cursor, apply_brugerauth
+
+
+def _fake_plan(active_org_index, user, organisations, all_delta_orgs):
+    plan = BrugerauthPlan(user)
+    plan.add = [1] if user != 'c' else []
+    return plan
+
+
+def test_job_processes_employees_in_parallel_and_aggregates_results():
+    employees = [{'user': 'a', 'organizations': []}, {'user': 'b', 'organizations': []}, {'user': 'a', 'organizations': []}]
+    running = {}
+    overlaps = []
+    steps = []
+
+    def fake_plan(active_org_index, user, organisations, all_delta_orgs):
+        steps.append(('plan', user))
+        return _fake_plan(active_org_index, user, organisations, all_delta_orgs)
+
+    def fake_apply(plan):
+        if running.get(plan.user):
+            overlaps.append(plan.user)
+        running[plan.user] = True
+        time.sleep(0.05)
+        running[plan.user] = False
+        steps.append(('apply', plan.user))
+        return plan.user != 'b'
+
+    with _patch_job(employees, fake_plan, fake_apply) as (commit_change_cursor, _):
+        summary = nexus_flow_brugerauth.job(max_workers=3)
+
+    assert overlaps == []
+    assert [step for step, user in steps if user == 'a'] == ['plan', 'apply', 'plan', 'apply']
+    assert [result['user'] for result in summary['results']] == ['a', 'b', 'a']
+    assert summary['succeeded'] == 2 and summary['failed'] == 1
+    commit_change_cursor.assert_called_once_with([employees[1]])
+
+
+def test_job_commits_change_cursor_when_all_employees_succeed():
+    employees = [{'user': 'b', 'organizations': []}, {'user': 'c', 'organizations': []}]
+
+    with _patch_job(employees, _fake_plan, lambda plan: True) as (commit_change_cursor, _):
+        summary = nexus_flow_brugerauth.job()
+
+    assert summary['failed'] == 0
+    commit_change_cursor.assert_called_once_with([])
+
+
+def test_job_applies_in_a_new_resource_scope():
+    scopes = []
+
+    def fake_plan(active_org_index, user, organisations, all_delta_orgs):
+        scopes.append(_resource_scope.get())
+        return _fake_plan(active_org_index, user, organisations, all_delta_orgs)
+
+    with _patch_job([{'user': 'a', 'organizations': []}], fake_plan, lambda plan: scopes.append(_resource_scope.get()) or True):
+        nexus_flow_brugerauth.job()
+
+    assert len(scopes) == 2 and None not in scopes and scopes[0] is not scopes[1]
+
+
+def test_job_dry_run_returns_plans_without_applying():
+    employees = [{'user': 'b', 'organizations': []}, {'user': 'c', 'organizations': []}]
+
+    with _patch_job(employees, _fake_plan, None) as (commit_change_cursor, apply_brugerauth):
+        summary = nexus_flow_brugerauth.job(dry_run=True)
+
+    apply_brugerauth.assert_not_called()
+    commit_change_cursor.assert_not_called()
+    assert summary['dry_run'] is True and summary['changed'] == 1
+    assert [result['changes']['add'] for result in summary['results']] == [[1], []]
+
+
+def test_collect_sync_ids_iteratively_in_tree_order():
+    tree = {'id': 1, 'syncId': 'a', 'children': [
+        {'id': 2, 'syncId': None, 'children': [{'id': 3, 'syncId': 'c', 'children': []}]},
+        {'id': 4, 'syncId': 'd'}
+    ]}
+    deep = node = {'id': 0, 'syncId': 's0', 'children': []}
+    for depth in range(1, 5000):
+        child = {'id': depth, 'syncId': f's{depth}', 'children': []}
+        node['children'].append(child)
+        node = child
+
+    assert nexus_flow_brugerauth._collect_syncIds_from_list_or_org(tree) == [{'id': 1, 'sync_id': 'a'}, {'id': 3, 'sync_id': 'c'}, {'id': 4, 'sync_id': 'd'}]
+    assert len(nexus_flow_brugerauth._collect_syncIds_from_list_or_org(deep)) == 5000
+
+
+def test_index_suppliers_reports_duplicates():
+    suppliers = [{'id': 10, 'organizationId': 1}, {'id': 11, 'organizationId': 1}, {'id': 12, 'organizationId': 2}, 'unexpected']
+
+    with patch.object(nexus_flow_brugerauth.logger, 'warning') as warning:
+        suppliers_by_org_id = nexus_flow_brugerauth._index_suppliers(suppliers)
+
+    assert {org_id: supplier['id'] for org_id, supplier in suppliers_by_org_id.items()} == {1: 10, 2: 12}
+    assert '{1: [10, 11]}' in warning.call_args.args[0]
+    assert nexus_flow_brugerauth._add_supplier_ids([{'id': 2, 'sync_id': 'b'}, {'id': 3, 'sync_id': 'c'}], suppliers_by_org_id) == \
+        [{'id': 2, 'sync_id': 'b', 'supplier': {'id': 12, 'organizationId': 2}}, {'id': 3, 'sync_id': 'c', 'supplier': None}]
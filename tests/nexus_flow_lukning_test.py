@@ -0,0 +1,92 @@
+import time
+from unittest.mock import patch
+from jobs import nexus_flow_lukning, nexus_flow_lukning_batch
+from nexus.nexus_client import NexusRequest
+
+
+def _fake_execute_nexus_flow(list_of_requests):
+    request = list_of_requests[-1]
+    resource = request.input_response
+    if request.link_href == "patientActivities":
+        return [{"id": 1, "name": "activity", "_links": {}}]
+    if request.link_href == "pathwayReferences":
+        return [{"id": 2, "name": "pathway"}, {"id": 3, "name": "Akutkald"}, {"id": 4, "name": "broken"}]
+    if request.link_href in ("self", "referencedObject"):
+        return {"id": resource["id"], "name": resource["name"]}
+    if request.link_href == "availableActions":
+        if resource["name"] == "broken":
+            return []
+        return [{"id": 30504, "_links": {}}]
+    if request.link_href == "updateFormData":
+        return request.payload
+
+
+def test_set_pathways_inactive_reports_each_item():
+    dashboard = {"view": {"widgets": [
+        {"headerTitle": "Alle borgers Handlingsanvisninger", "_links": {"patientActivities": {}, "pathwayReferences": {}}},
+        {"headerTitle": "Other", "_links": {}}
+    ]}}
+
+    # The pathway collections are fetched with execute_nexus_dag, which executes the requests directly
+    with patch.object(nexus_flow_lukning, 'execute_nexus_flow', side_effect=_fake_execute_nexus_flow), \
+         patch.object(NexusRequest, 'execute', lambda request, input_response: _fake_execute_nexus_flow([request])):
+        report = nexus_flow_lukning._set_pathways_inactive(dashboard, max_workers=4)
+
+    assert report["success"] is False
+    assert report["total"] == 3 and report["failed"] == 1
+    assert [(item["type"], item["id"], item["success"]) for item in report["items"]] == [
+        ("activity", 1, True), ("reference", 2, True), ("reference", 4, False)
+    ]
+    assert report["items"][2]["error"] == "Inactive action not found"
+
+
+def test_execute_lukning_runs_phases_concurrently():
+    def slow_phase(result):
+        def phase(*args):
+            time.sleep(0.2)
+            return result
+        return phase
+
+    with patch.object(nexus_flow_lukning.nexus_client, 'fetch_patient_by_query', return_value={"id": 1}), \
+         patch.object(nexus_flow_lukning.nexus_client, 'fetch_dashboard', return_value={"view": {"widgets": []}}), \
+         patch.object(nexus_flow_lukning, '_cancel_events', side_effect=slow_phase(True)), \
+         patch.object(nexus_flow_lukning, '_set_conditions_inactive', side_effect=slow_phase(None)), \
+         patch.object(nexus_flow_lukning, '_set_pathways_inactive', side_effect=slow_phase({"success": True, "items": []})):
+        start = time.time()
+        report = nexus_flow_lukning.execute_lukning("0101010101", parallel_phases=True)
+
+    assert time.time() - start < 0.35
+    assert report["success"] is False
+    assert report["phases"]["cancel_events"]["success"] is True
+    assert report["phases"]["conditions"]["success"] is False
+    assert report["phases"]["pathways"]["items"] == []
+    assert "time" in report["phases"]["pathways"]
+
+
+def test_execute_lukning_batch_summarises_in_input_order():
+    progress = []
+
+    def fake_execute_lukning(cpr, max_workers):
+        time.sleep(0.05 if cpr == "1" else 0)
+        return {"success": cpr != "2"}
+
+    with patch.object(nexus_flow_lukning, 'execute_lukning', side_effect=fake_execute_lukning):
+        summary = nexus_flow_lukning.execute_lukning_batch(["1", "2", "3"], max_workers=3, on_result=progress.append)
+
+    assert [result["cpr"] for result in summary["results"]] == ["1", "2", "3"]
+    assert (summary["success"], summary["total"], summary["succeeded"], summary["failed"]) == (False, 3, 2, 1)
+    assert len(progress) == 3 and progress[-1]["cpr"] == "1"
+
+
+def test_nested_pools_are_sized_from_the_connection_pool():
+    with patch.object(nexus_flow_lukning.nexus_client.api_client.session_pool, 'maxsize_for', return_value=10):
+        assert nexus_flow_lukning._lukning_workers(1, max_workers=8) == (1, 8)
+        assert nexus_flow_lukning._lukning_workers(20, batch_workers=4, max_workers=8) == (3, 1)
+        assert nexus_flow_lukning._lukning_workers(20, batch_workers=2, max_workers=8) == (2, 3)
+
+
+def test_lukning_batch_job_returns_summary():
+    with patch.object(nexus_flow_lukning, 'execute_lukning', return_value={"success": True}):
+        summary = nexus_flow_lukning_batch.job(cprs=["1", "2"])
+
+    assert summary["success"] is True and [result["cpr"] for result in summary["results"]] == ["1", "2"]
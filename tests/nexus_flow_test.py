@@ -0,0 +1,71 @@
+import time
+import pytest
+from nexus.nexus_flow import NexusFlowNode, NexusFlowError, execute_nexus_dag
+
+
+class FakeRequest:
+    def __init__(self, response=None, delay=0, error=None):
+        self.response = response
+        self.delay = delay
+        self.error = error
+        self.input_response = None
+
+    def execute(self, input_response):
+        self.input_response = input_response
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.response
+
+    def process_response(self, response_json, nexus_request):
+        return
+
+
+def test_independent_nodes_run_concurrently():
+    home = FakeRequest({"_links": {}})
+    dependent = FakeRequest("professional")
+    nodes = [
+        NexusFlowNode("a", FakeRequest("a", delay=0.2)),
+        NexusFlowNode("b", FakeRequest("b", delay=0.2)),
+        NexusFlowNode("home", home),
+        NexusFlowNode("dependent", dependent, depends_on=["home", "a"])
+    ]
+
+    start = time.time()
+    result = execute_nexus_dag(nodes, max_workers=4)
+
+    assert time.time() - start < 0.35
+    assert result["a"] == "a" and result["b"] == "b" and result["dependent"] == "professional"
+    assert dependent.input_response == {"_links": {}}
+    assert set(result.timings) == {"a", "b", "home", "dependent"}
+
+
+def test_failing_node_stops_flow():
+    skipped = FakeRequest("skipped")
+    nodes = [
+        NexusFlowNode("fails", FakeRequest(error=ValueError("Link 'self' not found in the response"))),
+        NexusFlowNode("skipped", skipped, depends_on=["fails"])
+    ]
+
+    with pytest.raises(NexusFlowError) as error:
+        execute_nexus_dag(nodes)
+
+    assert error.value.node_name == "fails"
+    assert "skipped" not in error.value.flow_result
+    assert skipped.input_response is None
+
+
+def test_cycles_are_rejected():
+    nodes = [NexusFlowNode("a", FakeRequest(), depends_on=["b"]), NexusFlowNode("b", FakeRequest(), depends_on=["a"])]
+
+    with pytest.raises(ValueError):
+        execute_nexus_dag(nodes)
+
+
+def test_node_without_response_fails_flow():
+    nodes = [NexusFlowNode("failed_request", FakeRequest(None))]
+
+    with pytest.raises(NexusFlowError) as error:
+        execute_nexus_dag(nodes)
+
+    assert error.value.node_name == "failed_request"
@@ -0,0 +1,55 @@
+import pytest
+from datetime import datetime
+
+from job_runner import JobRunner
+from scheduler import CronTrigger, IntervalTrigger, ScheduledJob, Scheduler
+
+
+def test_cron_trigger_next_after():
+    trigger = CronTrigger('*/30 6-18 * * 1-5')
+    friday_evening = datetime(2024, 5, 3, 18, 45)
+
+    assert trigger.next_after(None, datetime(2024, 5, 3, 10, 5)) == datetime(2024, 5, 3, 10, 30)
+    assert trigger.next_after(None, friday_evening) == datetime(2024, 5, 6, 6, 0)
+
+
+def test_interval_trigger_coalesces_missed_runs():
+    trigger = IntervalTrigger(600)
+
+    assert trigger.next_after(datetime(2024, 5, 3, 10, 0), datetime(2024, 5, 3, 10, 35)) == datetime(2024, 5, 3, 10, 40)
+
+
+def test_scheduler_skips_misfires_and_overlapping_runs(tmp_path):
+    runs = []
+    now = datetime(2024, 5, 3, 10, 0)
+    scheduled_job = ScheduledJob('job', lambda: runs.append(1) or True, IntervalTrigger(60), misfire_grace=30)
+    scheduled_job.next_run = now
+    scheduler = Scheduler([scheduled_job], lock_dir=str(tmp_path), runner=JobRunner())
+
+    records = scheduler.run_pending(now)
+    records[0].wait(5)
+    assert runs == [1] and scheduled_job.next_run == datetime(2024, 5, 3, 10, 1)
+
+    assert scheduler.run_pending(datetime(2024, 5, 3, 10, 2)) == []
+    assert scheduled_job.next_run == datetime(2024, 5, 3, 10, 3)
+
+
+def test_scheduler_leader_election(tmp_path):
+    leader = Scheduler([], lock_dir=str(tmp_path))
+    follower = Scheduler([], lock_dir=str(tmp_path))
+    leader_job = ScheduledJob('job', None, IntervalTrigger(60))
+    follower_job = ScheduledJob('job', None, IntervalTrigger(60))
+
+    assert leader._is_leader(leader_job)
+    assert not follower._is_leader(follower_job)
+    leader._release(leader_job)
+    assert follower._is_leader(follower_job)
+    follower._release(follower_job)
+
+
+def test_scheduler_refuses_to_start_without_lock_dir():
+    scheduler = Scheduler([], lock_dir='')
+
+    with pytest.raises(ValueError):
+        scheduler.start()
+    assert not scheduler._is_leader(ScheduledJob('job', None, IntervalTrigger(60)))